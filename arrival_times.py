@@ -0,0 +1,103 @@
+"""
+Arrival times of the pulses of whole blocks of events at once.
+
+The functions take 2D arrays of shape (n_events, roi) and a time axis,
+which is either 2D like the data (calibrated, one per event) or 1D,
+when it is the same for all events, e.g. np.arange(roi) without TC.
+
+Instead of np.polyfit per event, the straight line through the samples
+around the crossing is the closed form least squares solution,
+calculated from the sums over the window for all events at once.
+Events without a crossing get NaN.
+"""
+import numpy as np
+
+
+def first_crossing(data, threshold):
+    """
+    Index z of the first sample of every event, after which data crosses threshold,
+    so the crossing lies between sample z and z+1, and whether there is one at all.
+    threshold may be a scalar or one value per event.
+    """
+    threshold = np.reshape(threshold, (-1, 1))
+    crossing = np.diff(np.signbit(data - threshold), axis=1)
+    z = np.argmax(crossing, axis=1)
+    return z, crossing[np.arange(len(data)), z]
+
+
+def rising_crossing_before(data, threshold, stop):
+    """
+    Index z of the last sample before sample stop of every event, which is below
+    threshold, so data rises through threshold between z and z+1, and whether there is one.
+    """
+    threshold = np.reshape(threshold, (-1, 1))
+    below = (data < threshold) & (np.arange(data.shape[1]) < np.reshape(stop, (-1, 1)))
+    z = data.shape[1] - 1 - np.argmax(below[:, ::-1], axis=1)
+    return z, below.any(axis=1)
+
+
+def window_samples(z, window_length, roi):
+    """
+    The 2*window_length + 2 samples from z - window_length to z + 1 + window_length
+    of every event, shifted to stay inside the ROI.
+    """
+    n_samples = 2 * window_length + 2
+    start = np.clip(z - window_length, 0, roi - n_samples)
+    return start[:, np.newaxis] + np.arange(n_samples)
+
+
+def fit_lines(data, time, samples):
+    """
+    slope m and intercept b of the least squares line y = m * (t - t0) + b through
+    the samples of every event, with t0 the time of the first sample of the window,
+    to keep the sums small. returns m, b, t0.
+    """
+    rows = np.arange(len(data))[:, np.newaxis]
+    y = data[rows, samples]
+    if time.ndim == 1:
+        x = time[samples]
+    else:
+        x = time[rows, samples]
+    t0 = x[:, 0].copy()
+    x -= t0[:, np.newaxis]
+
+    n = samples.shape[1]
+    sum_x = x.sum(axis=1)
+    sum_y = y.sum(axis=1)
+    sum_xx = (x * x).sum(axis=1)
+    sum_xy = (x * y).sum(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        m = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x**2)
+    b = (sum_y - m * sum_x) / n
+    return m, b, t0
+
+
+def crossing_time(data, time, z, found, threshold, window_length=0):
+    """ time, when the line fitted around sample z crosses threshold """
+    samples = window_samples(z, window_length, data.shape[1])
+    m, b, t0 = fit_lines(data, time, samples)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        arrival_time = t0 + (threshold - b) / m
+    return np.where(found, arrival_time, np.nan)
+
+
+def leading_edge(data, time, threshold=0, window_length=0):
+    """
+    Vectorised digital_leading_edge_discriminator: the time of the first crossing
+    of threshold, taken from a straight line through the two samples around the crossing
+    plus window_length samples on either side.
+    """
+    z, found = first_crossing(data, threshold)
+    return crossing_time(data, time, z, found, threshold, window_length)
+
+
+def constant_fraction(data, time, fraction=0.5, window_length=0):
+    """
+    The time, when the rising edge in front of the maximum of every event crosses
+    fraction times that maximum, taken from a straight line like for leading_edge.
+    """
+    max_pos = np.argmax(data, axis=1)
+    threshold = fraction * data[np.arange(len(data)), max_pos]
+    z, found = rising_crossing_before(data, threshold, max_pos)
+    return crossing_time(data, time, z, found, threshold, window_length)
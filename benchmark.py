@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Usage:
+  benchmark.py [options]
+
+Measures the speed of the TC methods, the pulse extraction and the
+FakeEventGenerator on fake events, so runs on different commits can be compared.
+Every kernel and size runs in a fresh process, to get its own peak RSS.
+
+qr_tc keeps the whole sparse matrix of QRTC in memory, about 95 MB per 1000
+events, so above QR_MAX_EVENTS events it runs OnlineQRTC, which only keeps
+the 1024 x 1024 normal equations and needs about the same memory for any size.
+
+Options:
+  -o PATH          path of the JSON file with the results [default: benchmark.json]
+  --sizes LIST     comma separated numbers of events [default: 1000,10000,100000]
+  --kernels LIST   comma separated kernels or 'all' [default: all]
+  --block_size N   number of events generated at once [default: 1000]
+  --compare PATH   JSON file of an earlier run, to print the speed up against
+"""
+import os
+import json
+import platform
+import resource
+import subprocess
+import time
+import multiprocessing
+import numpy as np
+import pandas as pd
+from docopt import docopt
+from fake_event_gen import FakeEventGenerator
+from calc_local_tc import LocalTCAccumulator
+from calc_global_tc import GlobalTC
+from calc_qr_tc import QRTC, OnlineQRTC
+from pulse_extraction import PulseExtraction
+
+
+def local_tc(event_generator):
+    return LocalTCAccumulator(), None
+
+
+def global_tc(event_generator):
+    return GlobalTC(np.ones(1024)), None
+
+
+# the largest number of events, which qr_tc runs with QRTC, see above
+QR_MAX_EVENTS = 10000
+
+
+def qr_tc(event_generator):
+    tc_class = QRTC if event_generator.max_events <= QR_MAX_EVENTS else OnlineQRTC
+    consumer = tc_class()
+    return consumer, consumer.to_dataframe
+
+
+def extract_pulses(event_generator):
+    # the sine wave is as good as a pulse for timing the extraction
+    offset = np.zeros(1024)
+    cell_width = event_generator.cell_widths / event_generator.nominal_width
+    return PulseExtraction(offset, cell_width), None
+
+
+def fake_event_gen(event_generator):
+    return None, None
+
+
+KERNELS = {
+    "fake_event_gen": fake_event_gen,
+    "local_tc": local_tc,
+    "global_tc": global_tc,
+    "qr_tc": qr_tc,
+    "extract_pulses": extract_pulses,
+}
+
+
+def run_kernel(name, n_events, block_size=1000, roi=1024):
+    """
+    runs kernel `name` on n_events fake events and returns the seconds spent
+    generating the events, in the kernel and in its final solve (if any).
+    """
+    event_generator = FakeEventGenerator(
+        trigger_times=np.arange(n_events) * (1/300),
+        roi=roi,
+        random_phase=True,
+        block_size=block_size,
+    )
+    consumer, finish = KERNELS[name](event_generator)
+
+    times = {"generate": 0., "kernel": 0.}
+    blocks = event_generator.iter_blocks([(event_generator.pixel, event_generator.gain)])
+    while True:
+        start = time.perf_counter()
+        try:
+            data, stop_cells = next(blocks)
+        except StopIteration:
+            break
+        times["generate"] += time.perf_counter() - start
+
+        if consumer is not None:
+            start = time.perf_counter()
+            consumer.fill_block(data, stop_cells)
+            times["kernel"] += time.perf_counter() - start
+
+    if finish is not None:
+        start = time.perf_counter()
+        finish()
+        times["solve"] = time.perf_counter() - start
+
+    # ru_maxrss is in kB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return times, peak_rss_mb
+
+
+def benchmark(name, n_events, block_size=1000, roi=1024):
+    # a fresh process for every run, so peak RSS is not the one of an earlier run
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        times, peak_rss_mb = pool.apply(run_kernel, (name, n_events, block_size, roi))
+
+    seconds = sum(times.values()) if name == "fake_event_gen" else times["kernel"] + times.get("solve", 0)
+    return {
+        "kernel": name,
+        "n_events": n_events,
+        "roi": roi,
+        "seconds": seconds,
+        "events_per_second": n_events / seconds,
+        "peak_rss_mb": peak_rss_mb,
+        "times": times,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, earlier_results):
+    """ events per second of results relative to earlier_results, for the kernels and sizes in both """
+    new = pd.DataFrame(results).set_index(["kernel", "n_events"])
+    old = pd.DataFrame(earlier_results).set_index(["kernel", "n_events"])
+    table = pd.DataFrame({
+        "events_per_second_before": old.events_per_second,
+        "events_per_second": new.events_per_second,
+    }).dropna()
+    table["speed_up"] = table.events_per_second / table.events_per_second_before
+    return table
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    sizes = [int(size) for size in args["--sizes"].split(",")]
+    if args["--kernels"] == "all":
+        kernels = list(KERNELS)
+    else:
+        kernels = args["--kernels"].split(",")
+        for name in kernels:
+            assert name in KERNELS, "unknown kernel {}, choose from {}".format(name, list(KERNELS))
+
+    results = []
+    for name in kernels:
+        for n_events in sizes:
+            result = benchmark(name, n_events, block_size=int(args["--block_size"]))
+            print("{kernel:>16} {n_events:>7d} events: {seconds:8.2f} s {events_per_second:10.1f} events/s {peak_rss_mb:8.1f} MB".format(**result))
+            results.append(result)
+
+    report = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    with open(args["-o"], "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args["--compare"]:
+        with open(args["--compare"]) as f:
+            earlier = json.load(f)
+        print("compared to commit {}:".format(earlier["commit"]))
+        print(compare(results, earlier["results"]))
@@ -0,0 +1,73 @@
+"""
+Pedestal subtraction and time axes for whole blocks of events at once.
+
+A block has the shape (n_events, n_traces, roi), one trace for every
+(channel, gain), see event_blocks.iter_event_blocks. Every sample is
+looked up in the tables of its DRS4 cell in one gather, instead of event
+by event and trace by trace.
+"""
+import numpy as np
+from time_axis import TimeAxis, reused_buffer
+
+
+def read_offsets(path, columns=0):
+    """
+    offsets ala Taka per cell from the text file at path, column 0 by default,
+    like the scripts always used. A list of columns gives one row per column.
+    """
+    return np.genfromtxt(path)[:, columns].T
+
+
+class BlockCalibration:
+    """
+    offsets and cell_widths are tables of shape (n_traces, total_cells),
+    or (total_cells, ) to be used for all traces. cell_widths may be None,
+    when only the pedestal is needed.
+
+    The results are written into buffers, which are allocated for the first block
+    and reused for every following block, which is not larger.
+    So the returned arrays are only valid until the next call.
+    """
+
+    def __init__(self, offsets, cell_widths=None, total_cells=1024):
+        self.total_cells = total_cells
+        self.offsets = np.atleast_2d(np.asarray(offsets, dtype=np.float64))
+        self.time_axis = None if cell_widths is None else TimeAxis(cell_widths)
+        self._buffers = {}
+
+    def _buffer(self, name, shape, dtype):
+        return reused_buffer(self._buffers, name, shape, dtype)
+
+    def cells(self, stop_cells, roi):
+        """ DRS4 cell of every sample, shape (n_events, n_traces, roi) """
+        cells = self._buffer("cells", stop_cells.shape + (roi, ), np.intp)
+        np.add(stop_cells[..., np.newaxis], np.arange(roi), out=cells)
+        np.remainder(cells, self.total_cells, out=cells)
+        return cells
+
+    def _gather(self, table, cells, name):
+        """ table[trace, cell] of every sample of the block """
+        n_traces = cells.shape[1]
+        rows = np.arange(n_traces) if len(table) > 1 else np.zeros(n_traces, dtype=np.intp)
+        index = self._buffer("index", cells.shape, np.intp)
+        np.add(cells, (rows * self.total_cells)[:, np.newaxis], out=index)
+        values = self._buffer(name, cells.shape, np.float64)
+        np.take(table.ravel(), index, out=values)
+        return values
+
+    def __call__(self, raw_data, stop_cells):
+        """
+        raw_data of shape (n_events, n_traces, roi), stop_cells of shape (n_events, n_traces).
+        returns calibrated samples, their times (None without cell_widths) and their cells.
+        """
+        stop_cells = np.asarray(stop_cells)
+        cells = self.cells(stop_cells, raw_data.shape[-1])
+
+        calibrated = self._gather(self.offsets, cells, "calibrated")
+        np.subtract(raw_data, calibrated, out=calibrated)
+
+        time = None
+        if self.time_axis is not None:
+            time = self._buffer("time", cells.shape, np.float64)
+            self.time_axis(stop_cells, raw_data.shape[-1], out=time)
+        return calibrated, time, cells
@@ -7,12 +7,17 @@ Options:
   -i PATH             path to file with sine wave, to be analysed [default: SinWithHighOffset2.dat]
   -c PATH             path to textfile with offsets ala Taka, to be subtracted [default: Ped300Hz_forSine.dat]
   -o PATH             path to outfile for the cell widths [default: global_tc.csv]
-  --local_tc P        path to local_tc.csv file, which can be used as a starting point
+  --local_tc P        path to local_tc.csv file or <store>/local_tc, which can be used as a starting point
   --max_iterations N  maximum number of iterations, after which to stop [default: 10000]
-  --pixel N    pixel in which the sine wave should be analysed [default: 0]
-  --gain NAME  gain type which should be analysed [default: high]
+  --tolerance X       stop, when the RMS change of the cell widths over a window of events is below X, 0: never [default: 0]
+  --window N          number of events, over which the change of the cell widths is measured [default: 500]
+  --pixel N    pixel in which the sine wave should be analysed, or 'all' [default: 0]
+  --gain NAME  gain type which should be analysed: high, low or all [default: high]
+  --profile PATH      write wall time, calls and bytes per stage to PATH (.json or .csv)
   --fake       use FakeEventGenerator, ignores '-c' and expects '-i' to point to something like local_tc.csv
 """
+import json
+from functools import partial
 import dragonboard as dr
 import matplotlib.pyplot as plt
 import numpy as np
@@ -20,91 +25,364 @@ from tqdm import tqdm
 import time
 import pandas as pd
 from docopt import docopt
+from event_cache import open_event_source
+from event_blocks import fill_all_traces, tc_dataframe
+from zero_crossings import find_zero_crossings
+from tc_store import read_tc, read_cell_widths
+import profiling
+from profiling import stage
 
 
-def weight_on_edge(data, zxing):
+def crossing_pair_windows(calibrated, stop_cell, total_cells=1024, crossings=None):
     """
-    This weight is independent of the cell_width. 
-    So even, when we have already a good estimation of the cell width, 
-    this weight does not need to take the width into account.
+    Collects all pairs of neighbouring zero crossings of the same type
+    (rising-rising and falling-falling) into padded arrays.
+
+    calibrated is either a single trace with a single stop_cell, or
+    a 2D block of traces (n_traces, n_samples) with one stop cell per trace.
+
+    Element [..., k, :] describes the k-th pair of a trace, in the same order
+    in which the pairs used to be processed one by one: cells[..., k, :lengths[..., k]]
+    are the DRS4 cells spanned by this period and weights[..., k, :lengths[..., k]]
+    the fraction of each of these cells, which lies inside the period.
+    Traces with less pairs than others are padded with lengths == 0.
+
+    crossings are the find_zero_crossings() of calibrated, if already known.
+    """
+    block = np.atleast_2d(calibrated)
+    stop_cells = np.atleast_1d(stop_cell)
+    n_traces = len(block)
+
+    if crossings is None:
+        crossings = find_zero_crossings(block)
+    trace, sample = crossings.event, crossings.sample
+    n_crossings = np.bincount(trace, minlength=n_traces)
+    j = np.arange(len(trace)) - (np.cumsum(n_crossings) - n_crossings)[trace]
+
+    # crossing j and j+2 of the same trace are of the same type
+    first = np.nonzero(j + 2 < n_crossings[trace])[0]
+    pair_trace = trace[first]
+    starts = sample[first]
+    ends = sample[first + 2]
+    j = j[first]
+    # pairs starting at even crossings come first, like zero_crossings[0::2] did.
+    n_even_pairs = (n_crossings[pair_trace] + 1) // 2 - 1
+    pair_id = np.where(j % 2 == 0, j // 2, n_even_pairs + j // 2)
+
+    shape = (n_traces, max(n_crossings.max(initial=0) - 2, 0))
+    lengths = np.zeros(shape, dtype=int)
+    lengths[pair_trace, pair_id] = ends - starts + 1
+    first_sample = np.zeros(shape, dtype=int)
+    first_sample[pair_trace, pair_id] = starts
+
+    offsets = np.arange(lengths.max(initial=0))
+    cells = (stop_cells[:, np.newaxis, np.newaxis] + first_sample[..., np.newaxis] + offsets) % total_cells
+    weights = (offsets < lengths[..., np.newaxis]).astype(np.float64)
+    # without a single pair, the window axis has size 0 and cannot be indexed
+    if len(first):
+        weights[pair_trace, pair_id, 0] = 1 - crossings.fraction[first]
+        weights[pair_trace, pair_id, ends - starts] = crossings.fraction[first + 2]
+
+    if np.ndim(calibrated) == 1:
+        return cells[0], weights[0], lengths[0]
+    return cells, weights, lengths
+
+
+def apply_crossing_pairs(cell_width, cells, weights, lengths, nominal_period, T, max_width=2):
     """
-    value_before = data[zxing]
-    value_after = data[zxing + 1]
-    slope = value_after - value_before
-    return - value_before / slope
+    Applies the global TC correction of every crossing pair of one event,
+    as returned by crossing_pair_windows, to cell_width.
+
+    The correction multiplies the cells inside a period by n0 and all other
+    cells by n1. Instead of multiplying all 1024 cells for every pair,
+    we keep the cells outside the windows as `scale * w` and only touch
+    the ~33 cells each period spans. The result is the same as applying
+    the dense updates one after the other.
+    """
+    w = np.array(cell_width, dtype=np.float64)
+    n_cells = len(w)
+    scale = 1.
+    w_sum = float(w.sum())
+    w_max = float(w.max())
+    T = float(T)
+
+    for cells_, weights_, N in zip(cells, weights, lengths.tolist()):
+        # rows are padded to the longest period of the event
+        cells_ = cells_[:N]
+        weights_ = weights_[:N]
+
+        old = w[cells_]
+        measured_period = scale * float(np.dot(weights_, old))
+        if measured_period < nominal_period*0.7 or measured_period > nominal_period*1.3:
+            continue
+
+        n0 = nominal_period / measured_period
+        n1 = (T - nominal_period) / (T - measured_period)
+
+        # The next line is fishy:
+        #   * it should not be possibl to have a width < 0, but Ritt has shown it is.
+        #   * cells more than double their nominal size, seem impossible, but one cell with 200% width
+        #       can easily be accomplished with 10 cells having only 90% their nominal width.
+        #  Never the less, without this line, the result can become increadibly shitty!
+        width = np.minimum(np.maximum(old * (scale * (n1 + (n0 - n1) * weights_)), 0), max_width)
+        scale *= n1
+
+        if scale * w_max > max_width:
+            # a cell outside the window might get clipped, so do this one densely.
+            w *= scale
+            w[cells_] = width
+            w = np.clip(w, 0, max_width)
+            w /= w.mean()
+            scale = 1.
+            w_sum = float(w.sum())
+            w_max = float(w.max())
+            continue
+
+        new = width / scale
+        w[cells_] = new
+        w_sum += float(np.add.reduce(new - old))
+        w_max = max(w_max, float(np.maximum.reduce(new)))
+        # cell_width /= cell_width.mean()
+        scale = n_cells / w_sum
+
+    return w * scale
+
+
+def apply_crossing_pairs_block(cell_width, cells, weights, lengths, nominal_period, T, max_width=2):
+    """
+    Same as apply_crossing_pairs, but for a block of traces:
+    cell_width has shape (n_traces, n_cells) and the k-th pairs of all traces
+    are applied at the same time. For a single trace apply_crossing_pairs is faster.
+    """
+    w = np.array(cell_width, dtype=np.float64)
+    n_traces, n_cells = w.shape
+    T = np.broadcast_to(T, (n_traces, ))
+
+    scale = np.ones(n_traces)
+    w_sum = w.sum(axis=1)
+    w_max = w.max(axis=1)
+
+    offsets = np.arange(cells.shape[-1])
+    for k in range(lengths.shape[1]):
+        width = scale[:, np.newaxis] * w[np.arange(n_traces)[:, np.newaxis], cells[:, k]]
+        measured_period = (weights[:, k] * width).sum(axis=1)
+        skip = (measured_period < nominal_period*0.7) | (measured_period > nominal_period*1.3)
+        active = np.nonzero((lengths[:, k] > 0) & ~skip)[0]
+        if not len(active):
+            continue
+
+        rows = active[:, np.newaxis]
+        cells_ = cells[active, k]
+        weights_ = weights[active, k]
+        inside = offsets < lengths[active, k, np.newaxis]
+        old = w[rows, cells_]
+        width = width[active]
 
+        n0 = nominal_period / measured_period[active]
+        n1 = (T[active] - nominal_period) / (T[active] - measured_period[active])
+        correction = n0[:, np.newaxis] * weights_ + n1[:, np.newaxis] * (1 - weights_)
 
+        # see apply_crossing_pairs, why we clip at all.
+        width = np.clip(width * correction, 0, max_width)
+        scale[active] *= n1
 
-def calc_global_tc(event_generator, calib, pixel, gain, cell_width_guess):
-    f_calib = 30e6 # in Hz
-    unit_of_ti = 1e-9 # in seconds
-    nominal_period = 1 / (f_calib * unit_of_ti)
+        # if a cell outside the window might get clipped, do this trace densely.
+        dense = scale[active] * w_max[active] > max_width
+        if dense.any():
+            d = active[dense]
+            w_dense = w[d] * scale[d, np.newaxis]
+            dense_rows = np.arange(len(d))[:, np.newaxis]
+            w_dense[dense_rows, cells_[dense]] = np.where(
+                inside[dense], width[dense], w_dense[dense_rows, cells_[dense]])
+            w_dense = np.clip(w_dense, 0, max_width)
+            w_dense /= w_dense.mean(axis=1)[:, np.newaxis]
+            w[d] = w_dense
+            scale[d] = 1.
+            w_sum[d] = w_dense.sum(axis=1)
+            w_max[d] = w_dense.max(axis=1)
 
-    cell_width = np.copy(cell_width_guess) 
-    T = cell_width.sum()
-    stop_cells = np.zeros(1024, dtype=int)
+        s = active[~dense]
+        old = old[~dense]
+        new = np.where(inside[~dense], width[~dense] / scale[s, np.newaxis], old)
+        w[s[:, np.newaxis], cells_[~dense]] = new
+        w_sum[s] += new.sum(axis=1) - old.sum(axis=1)
+        w_max[s] = np.maximum(w_max[s], new.max(axis=1))
+        # cell_width /= cell_width.mean()
+        scale[s] = n_cells / w_sum[s]
 
-    number_of_zxings_per_cell = np.zeros(1024, dtype=int)
+    return w * scale[:, np.newaxis]
 
-    for event in tqdm(event_generator):
-        event = calib(event)
+
+class GlobalTC:
+    """
+    State of the iterative global TC of one or more traces.
+
+    fill() takes a single trace, or a 2D block with one row per trace,
+    fill_block() a block of events (n_events, n_traces, n_samples).
+    cell_width_guess is one row of cell widths for all traces, or one row per trace.
+
+    After every `window` events, change_rms is the RMS change of the cell widths
+    over these events, correction_rms is the RMS of the relative correction
+    (new / old - 1) of the last event. With tolerance > 0, the TC is converged
+    once change_rms < tolerance for all traces, fill_block() ignores further events
+    and the callers stop reading.
+    """
+
+    def __init__(self, cell_width_guess, n_traces=1, total_cells=1024, tolerance=0, window=500):
+        f_calib = 30e6 # in Hz
+        unit_of_ti = 1e-9 # in seconds
+        self.nominal_period = 1 / (f_calib * unit_of_ti)
+
+        self.n_traces = n_traces
+        self.total_cells = total_cells
+        self.cell_width = np.array(np.broadcast_to(cell_width_guess, (n_traces, total_cells)), dtype=np.float64)
+        self.T = self.cell_width.sum(axis=1)
+        self.stop_cells = np.zeros((n_traces, total_cells), dtype=int)
+        self.number_of_zxings_per_cell = np.zeros((n_traces, total_cells), dtype=int)
+
+        self.tolerance = tolerance
+        self.window = window
+        self.iterations = 0
+        self.converged = False
+        self.correction_rms = np.full(n_traces, np.nan)
+        self.change_rms = np.full(n_traces, np.nan)
+        self._window_start = self.cell_width.copy()
+
+    def fill(self, calibrated, stop_cell):
+        block = np.atleast_2d(calibrated)
+        stop_cells = np.atleast_1d(stop_cell)
+        n = self.total_cells
+
+        with stage("zero_crossings", nbytes=block.nbytes):
+            self.stop_cells[np.arange(self.n_traces), stop_cells % n] += 1
+            crossings = find_zero_crossings(block)
+            trace = crossings.event
+            self.number_of_zxings_per_cell[trace, (crossings.sample + stop_cells[trace]) % n] += 1
+
+            cells, weights, lengths = crossing_pair_windows(block, stop_cells, total_cells=n, crossings=crossings)
+        with stage("accumulate", nbytes=weights.nbytes):
+            old = self.cell_width.copy()
+            if self.n_traces == 1:
+                self.cell_width[0] = apply_crossing_pairs(
+                    self.cell_width[0], cells[0], weights[0], lengths[0], self.nominal_period, self.T[0])
+            else:
+                self.cell_width = apply_crossing_pairs_block(
+                    self.cell_width, cells, weights, lengths, self.nominal_period, self.T)
+
+        with stage("convergence"):
+            self.update_convergence(old)
+
+    def update_convergence(self, old):
+        self.iterations += 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.correction_rms = np.sqrt(np.mean((self.cell_width / old - 1)**2, axis=1))
+        if self.iterations % self.window == 0:
+            self.change_rms = np.sqrt(np.mean((self.cell_width - self._window_start)**2, axis=1))
+            self._window_start = self.cell_width.copy()
+            self.converged = bool(self.tolerance > 0 and np.all(self.change_rms < self.tolerance))
+
+    def fill_block(self, data, stop_cells):
+        # every correction depends on the previous one, so events go one by one.
+        for calibrated, stop_cell in zip(data, stop_cells):
+            if self.converged:
+                break
+            self.fill(calibrated, stop_cell)
+
+    def diagnostics(self):
+        """ iteration count and the final correction level of every trace """
+        return {
+            "iterations": self.iterations,
+            "converged": self.converged,
+            "tolerance": self.tolerance,
+            "window": self.window,
+            "correction_rms": self.correction_rms.tolist(),
+            "change_rms": self.change_rms.tolist(),
+        }
+
+    def to_dataframe(self, trace=0):
+        # Regarding the uncertainty of the cell width, we assume that the correction should become
+        # smaller and smaller, the more interations we perform.
+        # so the last corrections should be very close to 1. 
+
+        tc = pd.DataFrame({
+            "cell_width_mean": np.roll(self.cell_width[trace], 1),
+            "cell_width_std": np.zeros(self.total_cells),  # np.full((len(cell_width), np.nan)
+            "number_of_crossings": self.number_of_zxings_per_cell[trace],
+            "stop_cell": self.stop_cells[trace],
+            })
+        return tc
+
+
+def calc_global_tc(event_generator, calib, pixel, gain, cell_width_guess, tolerance=0, window=500):
+    """ returns the TC as DataFrame and the GlobalTC.diagnostics() """
+    global_tc = GlobalTC(cell_width_guess, tolerance=tolerance, window=window)
+
+    for event in tqdm(profiling.iterate("read", event_generator)):
+        with stage("calibration", nbytes=profiling.nbytes(event)):
+            event = calib(event)
         calibrated = event.data[pixel][gain]
         stop_cell = event.header.stop_cells[pixel][gain]
-        stop_cells[stop_cell % 1024] += 1
-        zero_crossings = np.where(np.diff(np.signbit(calibrated)))[0]
-        number_of_zxings_per_cell[(zero_crossings+stop_cell)%1024] += 1
+        global_tc.fill(calibrated, stop_cell)
+        if global_tc.converged:
+            break
 
-        for zxing_type in [zero_crossings[0::2], zero_crossings[1::2]]:
-            for start, end in zip(zxing_type[:-1], zxing_type[1:]):
+    return global_tc.to_dataframe(), global_tc.diagnostics()
 
-                N = end - start + 1
-                weights = np.zeros(1024)
-                weights[(stop_cell + start + np.arange(N))%1024] = 1.
-                weights[(stop_cell + start)%1024] = 1 - weight_on_edge(calibrated, start)
-                weights[(stop_cell + end)%1024] = weight_on_edge(calibrated, end)
 
-                measured_period = (weights * cell_width).sum()
-                if measured_period < nominal_period*0.7 or measured_period > nominal_period*1.3:
-                    continue
-
-                n0 = nominal_period / measured_period
-                n1 = (T - nominal_period) / (T - measured_period)
+def calc_global_tc_all(event_generator, calib, cell_width_guess, pixels=None, gains=None, tolerance=0, window=500):
+    """
+    the global TC of all pixels and gains (or the given ones) as one DataFrame,
+    and the diagnostics, which converge, once all traces have.
+    cell_width_guess is one row for all traces, or a function, which gives one
+    row per trace for the traces of the first event, like read_cell_widths.
+    """
+    def make_tc(traces):
+        guess = cell_width_guess(traces) if callable(cell_width_guess) else cell_width_guess
+        return GlobalTC(guess, n_traces=len(traces), tolerance=tolerance, window=window)
 
-                correction = n0 * weights + n1 * (1-weights)
-                cell_width *= correction
+    traces, global_tc = fill_all_traces(event_generator, calib, make_tc, pixels, gains)
 
-                # The next line is fishy:
-                #   * it should not be possibl to have a width < 0, but Ritt has shown it is.
-                #   * cells more than double their nominal size, seem impossible, but one cell with 200% width
-                #       can easily be accomplished with 10 cells having only 90% their nominal width.
-                #  Never the less, without this line, the result can become increadibly shitty!
-                cell_width = np.clip(cell_width, 0, 2)  
-                cell_width /= cell_width.mean()
+    diagnostics = global_tc.diagnostics()
+    diagnostics["traces"] = traces
+    return tc_dataframe(traces, global_tc), diagnostics
 
 
-    # Regarding the uncertainty of the cell width, we assume that the correction should become
-    # smaller and smaller, the more interations we perform.
-    # so the last corrections should be very close to 1. 
+def nan_to_none(value):
+    """
+    NaN and inf are not valid JSON, e.g. change_rms before the first window is full,
+    or the condition_estimate of a trace without crossings, they become null.
+    """
+    if isinstance(value, dict):
+        return {key: nan_to_none(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [nan_to_none(item) for item in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
 
-    tc = pd.DataFrame({
-        "cell_width_mean": np.roll(cell_width, 1),
-        "cell_width_std": np.zeros(1024),  # np.full((len(cell_width), np.nan)
-        "number_of_crossings": number_of_zxings_per_cell,
-        "stop_cell": stop_cells,
-        })
-    return tc
 
+def write_diagnostics(csv_path, diagnostics):
+    """ writes diagnostics as .json next to the TC csv file at csv_path """
+    path = csv_path.replace(".csv", ".json")
+    with open(path, "w") as f:
+        json.dump(nan_to_none(diagnostics), f, indent=2, allow_nan=False)
+    return path
 
 
 if __name__ == "__main__":
     args = docopt(__doc__)
+    if args["--profile"]:
+        profiling.enable(args["--profile"])
     args["--max_iterations"] = int(args["--max_iterations"])
-    pixel = int(args["--pixel"])
-    gain = args["--gain"]
-    assert gain in ["high", "low"]
+    args["--tolerance"] = float(args["--tolerance"])
+    args["--window"] = int(args["--window"])
+    all_traces = "all" in (args["--pixel"], args["--gain"])
+    pixel = None if args["--pixel"] == "all" else int(args["--pixel"])
+    gain = None if args["--gain"] == "all" else args["--gain"]
+    assert gain in ["high", "low", None]
     
     if not args["--fake"]:
-        event_generator = dr.EventGenerator(
+        event_generator = open_event_source(
             args["-i"], 
             max_events=args["--max_iterations"],
         )
@@ -122,19 +400,37 @@ if __name__ == "__main__":
 
     if not args["--local_tc"]:
         cell_width_guess=np.ones(1024)
+    elif all_traces:
+        cell_width_guess=partial(read_cell_widths, args["--local_tc"])
     else:
-        cell_width_guess=pd.read_csv(args["--local_tc"])["cell_width_mean"].values
+        cell_width_guess=read_tc(args["--local_tc"], pixel, gain)["cell_width_mean"].values
 
-    tc = calc_global_tc(
-        event_generator, 
-        calib, 
-        pixel, 
-        gain, 
-        cell_width_guess)
+    if all_traces:
+        tc, diagnostics = calc_global_tc_all(
+            event_generator,
+            calib,
+            cell_width_guess,
+            pixels=None if pixel is None else [pixel],
+            gains=None if gain is None else [gain],
+            tolerance=args["--tolerance"],
+            window=args["--window"])
+    else:
+        tc, diagnostics = calc_global_tc(
+            event_generator, 
+            calib, 
+            pixel, 
+            gain, 
+            cell_width_guess,
+            tolerance=args["--tolerance"],
+            window=args["--window"])
+    print("iterations: {iterations}, converged: {converged}, change_rms: {change_rms}, correction_rms: {correction_rms}".format(**diagnostics))
 
 
     if args["--fake"]:
-        tc["cell_width_truth"] = event_generator.cell_widths / event_generator.cell_widths.mean()
+        cell_width_truth = event_generator.cell_widths / event_generator.cell_widths.mean()
+        tc["cell_width_truth"] = np.resize(cell_width_truth, len(tc))
      
-    tc.to_csv(args["-o"], index=False)
+    with stage("write"):
+        tc.to_csv(args["-o"], index=False)
+        write_diagnostics(args["-o"], diagnostics)
 
@@ -7,9 +7,12 @@ Options:
   -i PATH      path to file with sine wave, to be analysed [default: SinWithHighOffset2.dat]
   -c PATH      path to textfile with offsets ala Taka, to be subtracted [default: Ped300Hz_forSine.dat]
   -o PATH      path to outfile for the cell widths [default: local_tc.csv]
-  --pixel N    pixel in which the sine wave should be analysed [default: 0]
-  --gain NAME  gain type which should be analysed [default: high]
+  --jobs N     number of worker processes, each reads its own range of events.
+               A .dat file without a valid cache is converted into one first, see event_cache.py [default: 1]
+  --pixel N    pixel in which the sine wave should be analysed, or 'all' [default: 0]
+  --gain NAME  gain type which should be analysed: high, low or all [default: high]
   --fake       use FakeEventGenerator, ignores '-c' and expects '-i' to point to something like local_tc.csv
+  --profile PATH  write wall time, calls and bytes per stage to PATH (.json or .csv)
 """
 import dragonboard as dr
 import numpy as np
@@ -17,66 +20,198 @@ from tqdm import tqdm
 from docopt import docopt
 import pandas as pd
 import matplotlib.pyplot as plt
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from event_cache import open_event_source, open_event_range, valid_cache_path, convert
+from event_blocks import select_traces, iter_event_blocks, fill_all_traces, tc_dataframe
+from zero_crossings import find_zero_crossings
+import profiling
+from profiling import stage
+
+class LocalTCAccumulator:
+    """
+    Streaming per cell statistics of the absolute slopes at the zero crossings
+    of a sine wave. Only count, sum and sum of squares are kept for every cell,
+    so memory does not depend on the number of events.
+
+    With n_traces > 1, fill() takes a 2D block of traces (n_traces, n_samples)
+    and one stop cell per trace, and all traces are accumulated at once.
+    """
+
+    def __init__(self, total_cells=1024, n_traces=1):
+        self.total_cells = total_cells
+        self.n_traces = n_traces
+        shape = (n_traces, total_cells)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.slope_sum = np.zeros(shape, dtype=np.float64)
+        self.slope_sum_sq = np.zeros(shape, dtype=np.float64)
+        self.stop_cells = np.zeros(shape, dtype=int)
+
+    def fill(self, calibrated, stop_cell, trace_of_row=None):
+        """
+        Rows of a 2D calibrated belong to trace 0, 1, ... n_traces-1.
+        To fill several events at once, stack them and pass trace_of_row,
+        the trace each row belongs to.
+        """
+        block = np.atleast_2d(calibrated)
+        stop_cells = np.atleast_1d(stop_cell)
+        if trace_of_row is None:
+            trace_of_row = np.arange(len(block))
+
+        with stage("zero_crossings", nbytes=block.nbytes):
+            crossings = find_zero_crossings(block)
+            row, zero_crossings = crossings.event, crossings.sample
+            absolute_slopes = np.abs(crossings.slope).astype(np.float64)
+
+        with stage("accumulate", nbytes=absolute_slopes.nbytes):
+            shape = self.count.shape
+            n = self.count.size
+            self.stop_cells += np.bincount(
+                trace_of_row * self.total_cells + stop_cells % self.total_cells,
+                minlength=n).reshape(shape)
+            zero_crossing_cells = dr.sample2cell(zero_crossings+1,
+                stop_cell=stop_cells[row],
+                total_cells=self.total_cells)
+
+            flat_cells = trace_of_row[row] * self.total_cells + zero_crossing_cells
+            self.count += np.bincount(flat_cells, minlength=n).reshape(shape)
+            self.slope_sum += np.bincount(flat_cells, weights=absolute_slopes, minlength=n).reshape(shape)
+            self.slope_sum_sq += np.bincount(flat_cells, weights=absolute_slopes**2, minlength=n).reshape(shape)
+
+    def fill_block(self, data, stop_cells):
+        """ data of shape (n_events, n_traces, roi), stop_cells of shape (n_events, n_traces) """
+        n_events, n_traces, roi = data.shape
+        self.fill(
+            data.reshape(n_events * n_traces, roi),
+            stop_cells.reshape(-1),
+            trace_of_row=np.tile(np.arange(n_traces), n_events),
+        )
+
+    def sums(self):
+        """ all the statistics, e.g. to send them from a worker to the main process """
+        return self.count, self.slope_sum, self.slope_sum_sq, self.stop_cells
+
+    def add_sums(self, count, slope_sum, slope_sum_sq, stop_cells):
+        self.count += count
+        self.slope_sum += slope_sum
+        self.slope_sum_sq += slope_sum_sq
+        self.stop_cells += stop_cells
+        return self
+
+    def merge(self, other):
+        """ add the statistics of another accumulator, e.g. of a different chunk of events """
+        return self.add_sums(*other.sums())
+
+    def to_dataframe(self, trace=0):
+        count = self.count[trace]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            slope_mean = self.slope_sum[trace] / count
+            slope_std = np.sqrt(np.maximum(self.slope_sum_sq[trace] / count - slope_mean**2, 0))
+            slope_std_of_mean = slope_std / np.sqrt(count)
+
+        tc = pd.DataFrame({
+                "cell_width_mean": slope_mean.astype(np.float32),
+                "cell_width_std": slope_std_of_mean.astype(np.float32),
+                "number_of_crossings": count.astype(np.int32),
+                "stop_cell": self.stop_cells[trace],
+                "slope_mean": slope_mean.astype(np.float32),
+            })
+
+        average_of_all_slopes = tc.cell_width_mean.dropna().mean()
+        tc["cell_width_mean"] /= average_of_all_slopes
+        tc["cell_width_std"]  /= average_of_all_slopes
+
+        return tc
+
 
 def calc_local_tc(event_generator, calib, pixel, gain):
-    all_slopes = [[] for i in range(1024)]
-    stop_cells = np.zeros(1024, dtype=int)
+    accumulator = LocalTCAccumulator()
 
-    for event in tqdm(event_generator):
-        event = calib(event)
+    for event in tqdm(profiling.iterate("read", event_generator)):
+        with stage("calibration", nbytes=profiling.nbytes(event)):
+            event = calib(event)
         calibrated = event.data[pixel][gain]
-        
-        zero_crossings = np.where(np.diff(np.signbit(calibrated)))[0]
-        slopes = calibrated[zero_crossings + 1] - calibrated[zero_crossings]
-        absolute_slopes = np.abs(slopes)
-
-        sc = event.header.stop_cells[pixel][gain]
-        stop_cells[sc%1024] += 1
-        zero_crossing_cells = dr.sample2cell(zero_crossings+1, 
-            stop_cell=sc,
-            total_cells=1024)
-        
-        for abs_slope, cell_id in zip(absolute_slopes, zero_crossing_cells):
-            all_slopes[cell_id].append(abs_slope)
-
-    tc = pd.DataFrame({
-            "cell_width_mean": np.zeros(len(all_slopes), dtype=np.float32),
-            "cell_width_std": np.zeros(len(all_slopes), dtype=np.float32),
-            "number_of_crossings": np.zeros(len(all_slopes), dtype=np.int32),
-            "stop_cell": stop_cells,
-            "slope_mean": np.zeros(len(all_slopes), dtype=np.float32),
-        })
-    for cell_id, slopes in enumerate(all_slopes):
-        slopes = np.array(slopes)
-        tc.loc[cell_id, "number_of_crossings"] = len(slopes)
-        tc.loc[cell_id, "cell_width_mean"] = np.mean(slopes) # np.median(slopes)
-        tc.loc[cell_id, "slope_mean"] = slopes.mean()
-        if False:
-            plt.hist(slopes, bins=50, histtype="step")
-            plt.title(str(len(slopes)))
-            ax = plt.gca()
-            ax.ticklabel_format(useOffset=False)
-            plt.savefig("slopes/{0:04d}.png".format(cell_id))
-            plt.close("all")
-        
-        tc.loc[cell_id, "cell_width_std"] = slopes.std() / np.sqrt(len(slopes))
-
-
-    average_of_all_slopes = tc.cell_width_mean.dropna().mean()
-    tc["cell_width_mean"] /= average_of_all_slopes
-    tc["cell_width_std"]  /= average_of_all_slopes
-
-    return tc
+        accumulator.fill(calibrated, event.header.stop_cells[pixel][gain])
+
+    return accumulator.to_dataframe()
+
+
+def calc_local_tc_all(event_generator, calib, pixels=None, gains=None):
+    """ the local TC of all pixels and gains (or the given ones) as one DataFrame """
+    traces, accumulator = fill_all_traces(
+        event_generator, calib, lambda traces: LocalTCAccumulator(n_traces=len(traces)), pixels, gains)
+    return tc_dataframe(traces, accumulator)
+
+
+def file_range(path, start, stop, calib, traces):
+    """ calibrated blocks of the events start ... stop-1 of the file at path """
+    events = open_event_range(path, start, stop)
+    return iter_event_blocks(events, traces, block_size=stop - start, calib=calib)
+
+
+def fake_range(event_generator, start, stop):
+    """ the events start ... stop-1 of a FakeEventGenerator as a single block, generating it counts as read """
+    def blocks():
+        block = event_generator.generate_block(start, stop)
+        yield block.data[:, np.newaxis], block.stop_cells[:, np.newaxis]
+    return profiling.iterate("read", blocks())
+
+
+def _fill_range(read_range, start, stop, n_traces, profile=None):
+    """
+    worker of calc_local_tc_parallel, reads its events itself and returns only the sums,
+    and with profile, the path of the parent's report, the totals of its stages.
+    """
+    if profile:
+        profiling.profiler.start_worker(profile)
+    accumulator = LocalTCAccumulator(n_traces=n_traces)
+    for data, stop_cells in read_range(start, stop):
+        accumulator.fill_block(data, stop_cells)
+    return accumulator.sums(), profiling.profiler.totals() if profile else {}
+
+
+def calc_local_tc_parallel(read_range, n_events, n_traces=1, jobs=2, chunk_size=500):
+    """
+    The events are split into ranges of chunk_size events, every worker process
+    reads, calibrates and accumulates its ranges on its own, with
+    read_range(start, stop), e.g. a partial of file_range or fake_range.
+    The partial sums are merged in event order, so the result is the
+    same as the one of calc_local_tc_all, up to floating point rounding.
+    The stages of the workers are added to the profile, so their seconds
+    are summed over all processes, not wall time.
+
+    returns the merged LocalTCAccumulator.
+    """
+    accumulator = LocalTCAccumulator(n_traces=n_traces)
+    starts = range(0, n_events, chunk_size)
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [
+            pool.submit(_fill_range, read_range, start, min(start + chunk_size, n_events), n_traces, profiling.profiler.path)
+            for start in starts
+        ]
+        for future in tqdm(futures, unit="chunk"):
+            sums, totals = future.result()
+            profiling.profiler.add_totals(totals)
+            with stage("merge"):
+                accumulator.add_sums(*sums)
+    return accumulator
+
+
+def no_calibration(event):
+    return event
 
 
 if __name__ == "__main__":
     args = docopt(__doc__)
-    pixel = int(args["--pixel"])
-    gain = args["--gain"]
-    assert gain in ["high", "low"]
+    if args["--profile"]:
+        profiling.enable(args["--profile"])
+    all_traces = "all" in (args["--pixel"], args["--gain"])
+    pixel = None if args["--pixel"] == "all" else int(args["--pixel"])
+    gain = None if args["--gain"] == "all" else args["--gain"]
+    assert gain in ["high", "low", None]
     
     if not args["--fake"]:
-        event_generator = dr.EventGenerator(args["-i"])
+        event_generator = open_event_source(args["-i"])
         calib = dr.calibration.TakaOffsetCalibration(args["-c"])
     else:
         from fake_event_gen import FakeEventGenerator
@@ -88,11 +223,42 @@ if __name__ == "__main__":
             sine_frequency=30e6 * (1+1e-7),
             cell_width=args["-i"],
         )
-        calib = lambda x: x
+        calib = no_calibration
 
-    tc = calc_local_tc(event_generator, calib, pixel, gain)
+    jobs = int(args["--jobs"])
+    if jobs > 1:
+        if args["--fake"]:
+            traces = [(event_generator.pixel, event_generator.gain)]
+            read_range = partial(fake_range, event_generator)
+            n_events = event_generator.max_events
+        else:
+            # the workers slice the cache, instead of decoding the file up to their range
+            if valid_cache_path(args["-i"]) is None:
+                convert(args["-i"])
+            event_generator = open_event_source(args["-i"])
+            traces = select_traces(
+                calib(event_generator.event(0)),
+                pixels=None if pixel is None else [pixel],
+                gains=None if gain is None else [gain])
+            read_range = partial(file_range, args["-i"], calib=calib, traces=traces)
+            n_events = len(event_generator)
+        accumulator = calc_local_tc_parallel(read_range, n_events, n_traces=len(traces), jobs=jobs)
+        if all_traces:
+            tc = tc_dataframe(traces, accumulator)
+        else:
+            tc = accumulator.to_dataframe()
+    elif all_traces:
+        tc = calc_local_tc_all(
+            event_generator,
+            calib,
+            pixels=None if pixel is None else [pixel],
+            gains=None if gain is None else [gain])
+    else:
+        tc = calc_local_tc(event_generator, calib, pixel, gain)
 
     if args["--fake"]:
-        tc["cell_width_truth"] = event_generator.cell_widths / event_generator.cell_widths.mean()
+        cell_width_truth = event_generator.cell_widths / event_generator.cell_widths.mean()
+        tc["cell_width_truth"] = np.resize(cell_width_truth, len(tc))
      
-    tc.to_csv(args["-o"], index=False)
\ No newline at end of file
+    with stage("write"):
+        tc.to_csv(args["-o"], index=False)
\ No newline at end of file
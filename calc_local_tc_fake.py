@@ -8,6 +8,7 @@ Options:
   -o PATH      path to outfile for the cell widths [default: local_tc.csv]
   --pixel N    pixel in which the sine wave should be analysed [default: 0]
   --gain NAME  gain type which should be analysed [default: high] 
+  --profile PATH  write wall time, calls and bytes per stage to PATH (.json or .csv)
 """
 import dragonboard as dr
 import numpy as np
@@ -16,46 +17,48 @@ from docopt import docopt
 import pandas as pd
 import matplotlib.pyplot as plt
 from fake_event_gen import FakeEventGenerator as EventGenerator
+from zero_crossings import find_zero_crossings
+import profiling
+from profiling import stage
 
 args = docopt(__doc__)
 print(args)
+if args["--profile"]:
+    profiling.enable(args["--profile"])
 np.random.seed(0)
 
 
 
 times = np.random.uniform(0, 1e-8, 10000).cumsum()
-event_generator = EventGenerator(times)
-calib = lambda x: x
 
 pixel = int(args["--pixel"])
 gain = args["--gain"]
 assert gain in ["high", "low"]
+event_generator = EventGenerator(times, pixel=pixel, gain=gain)
 
 
-all_slopes = [[] for i in range(1024)]
+count = np.zeros(1024)
+slope_sum = np.zeros(1024)
+slope_sum_sq = np.zeros(1024)
 
 #fig, a = plt.subplots(1)
 
-for event in tqdm(event_generator):
-    event = calib(event)
-    calibrated = event.data[pixel][gain]
+blocks = profiling.iterate("generate", event_generator.iter_blocks([(pixel, gain)]))
+for data, stop_cells in tqdm(blocks, total=-(-len(event_generator) // event_generator.block_size), unit="block"):
+    with stage("zero_crossings", nbytes=data.nbytes):
+        crossings = find_zero_crossings(data[:, 0])
+        zero_crossing_cells = dr.sample2cell(crossings.sample, 
+            stop_cell=stop_cells[crossings.event, 0], 
+            total_cells=1024)
     
-    zero_crossings = np.where(np.diff(np.signbit(calibrated)))[0]
-    slope = calibrated[zero_crossings + 1] - calibrated[zero_crossings]
-
-    zero_crossing_cells = dr.sample2cell(zero_crossings, 
-        stop_cell=event.header.stop_cells[pixel][gain], 
-        total_cells=1024)
-    
-    for crossing_number, cell_id in enumerate(zero_crossing_cells):
-        all_slopes[cell_id].append(np.abs(slope[crossing_number]))
-
-slope_mean = np.zeros(1024)
-slope_std = np.zeros(1024)
-for cell_id, slopes in enumerate(all_slopes):
-    slopes = np.array(slopes)
-    slope_mean[cell_id] = slopes.mean()
-    slope_std[cell_id] = slopes.std() / np.sqrt(len(slopes))
+    with stage("accumulate"):
+        absolute_slopes = np.abs(crossings.slope)
+        count += np.bincount(zero_crossing_cells, minlength=1024)
+        slope_sum += np.bincount(zero_crossing_cells, weights=absolute_slopes, minlength=1024)
+        slope_sum_sq += np.bincount(zero_crossing_cells, weights=absolute_slopes**2, minlength=1024)
+
+slope_mean = slope_sum / count
+slope_std = np.sqrt(np.maximum(slope_sum_sq / count - slope_mean**2, 0)) / np.sqrt(count)
 
 print(slope_std)
 df = pd.DataFrame({
@@ -7,10 +7,18 @@ Options:
   -i PATH             path to file with sine wave, to be analysed [default: SinWithHighOffset2.dat]
   -c PATH             path to textfile with offsets ala Taka, to be subtracted [default: Ped300Hz_forSine.dat]
   -o PATH             path to outfile for the cell widths [default: qr_tc.csv]
-  --local_tc P        path to local_tc.csv file, which can be used as a starting point
+  --local_tc P        path to local_tc.csv file or <store>/local_tc, which is used as starting point of the solver
+  --solver NAME       lsqr or lsmr [default: lsqr]
+  --atol X            stopping tolerance of the solver, see scipy.sparse.linalg.lsqr [default: 1e-6]
+  --btol X            stopping tolerance of the solver, see scipy.sparse.linalg.lsqr [default: 1e-6]
+  --iter_lim N        maximum number of solver iterations [default: auto]
+  --scale_columns     divide the columns of the matrix by their norm before solving
+  --online            fold the rows into the normal equations as they come, memory does not grow with the events
+  --flush_rows N      with --online, number of rows collected before they are folded in [default: 32768]
   --max_iterations N  maximum number of iterations, after which to stop [default: 7000]
-  --pixel N    pixel in which the sine wave should be analysed [default: 0]
-  --gain NAME  gain type which should be analysed [default: high]
+  --pixel N    pixel in which the sine wave should be analysed, or 'all' [default: 0]
+  --gain NAME  gain type which should be analysed: high, low or all [default: high]
+  --profile PATH      write wall time, calls and bytes per stage to PATH (.json or .csv)
   --fake       use FakeEventGenerator, ignores '-i' and '-c'.
 """
 import dragonboard as dr
@@ -18,79 +26,300 @@ import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
 import time
+from functools import partial
 import pandas as pd
 from docopt import docopt
-from scipy.sparse import lil_matrix, csr_matrix, csc_matrix
+from scipy.sparse import lil_matrix, csr_matrix, csc_matrix, coo_matrix
 from numpy.linalg import matrix_rank
+from scipy.sparse import diags
 from scipy.sparse.linalg import lsqr, lsmr, svds
 import matplotlib.pyplot as plt
+from calc_global_tc import crossing_pair_windows, write_diagnostics
+from event_cache import open_event_source
+from event_blocks import fill_all_traces, tc_dataframe
+from zero_crossings import find_zero_crossings
+from tc_store import read_tc, read_cell_widths
+import profiling
+from profiling import stage
 
 
 
-def weight_on_edge(data, zxing):
+class SparseRows:
     """
-    This weight is independent of the cell_width. 
-    So even, when we have already a good estimation of the cell width, 
-    this weight does not need to take the width into account.
+    Rows of a sparse matrix, collected as COO triplets in preallocated arrays.
+
+    The arrays grow by doubling their capacity, so memory scales with the
+    number of nonzero entries and not with number of rows x number of columns.
+    """
+
+    def __init__(self, n_columns=1024, capacity=2**16):
+        self.n_columns = n_columns
+        self.n_rows = 0
+        self.nnz = 0
+        self.rows = np.empty(capacity, dtype=np.int32)
+        self.cols = np.empty(capacity, dtype=np.int32)
+        self.data = np.empty(capacity, dtype=np.float64)
+
+    def _reserve(self, n):
+        if self.nnz + n <= len(self.data):
+            return
+        capacity = max(2 * len(self.data), self.nnz + n)
+        for name in ["rows", "cols", "data"]:
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.nnz] = old[:self.nnz]
+            setattr(self, name, new)
+
+    def append(self, cells, weights):
+        """
+        Appends one row for every line of the 2D arrays cells and weights,
+        only nonzero weights are stored.
+        """
+        row_ids, entry_ids = np.nonzero(weights)
+        n = len(row_ids)
+        self._reserve(n)
+        s = slice(self.nnz, self.nnz + n)
+        self.rows[s] = self.n_rows + row_ids
+        self.cols[s] = cells[row_ids, entry_ids]
+        self.data[s] = weights[row_ids, entry_ids]
+        self.nnz += n
+        self.n_rows += len(weights)
+
+    def clear(self):
+        self.n_rows = 0
+        self.nnz = 0
+
+    def tocsr(self):
+        return coo_matrix(
+            (self.data[:self.nnz], (self.rows[:self.nnz], self.cols[:self.nnz])),
+            shape=(self.n_rows, self.n_columns),
+        ).tocsr()
+
+
+SOLVERS = {"lsqr": lsqr, "lsmr": lsmr}
+
+
+class QRTC:
+    """
+    Collects one sparse system of equations per trace: every complete period
+    between two crossing pairs gives one row, saying its cells add up to the nominal period.
+    The cell widths are the least squares solution, see solve().
+
+    cell_width_guess, e.g. the local TC, is the starting point of the solver,
+    one row for all traces, or one row per trace.
+    solver is "lsqr" or "lsmr", atol, btol and iter_lim are passed on to it.
+    With scale_columns, every column is divided by its norm before solving.
     """
-    value_before = data[zxing]
-    value_after = data[zxing + 1]
-    slope = value_after - value_before
-    return - value_before / slope
 
+    def __init__(self, n_traces=1, total_cells=1024, cell_width_guess=None,
+            solver="lsqr", atol=1e-6, btol=1e-6, iter_lim=None, scale_columns=False):
+        assert solver in SOLVERS, "solver must be one of {}".format(list(SOLVERS))
+        self.n_traces = n_traces
+        self.total_cells = total_cells
+        self.cell_width_guess = cell_width_guess
+        self.solver = solver
+        self.atol = atol
+        self.btol = btol
+        self.iter_lim = iter_lim
+        self.scale_columns = scale_columns
+        self.solver_diagnostics = [None] * n_traces
+        self.stop_cells = np.zeros((n_traces, total_cells), dtype=int)
+        self.number_of_zxings_per_cell = np.zeros((n_traces, total_cells), dtype=int)
+        self.weight_matrices = [SparseRows(n_columns=total_cells) for i in range(n_traces)]
+
+    def fill(self, calibrated, stop_cell):
+        block = np.atleast_2d(calibrated)
+        stop_cells = np.atleast_1d(stop_cell)
+        n = self.total_cells
+
+        with stage("zero_crossings", nbytes=block.nbytes):
+            self.stop_cells[np.arange(self.n_traces), stop_cells % n] += 1
+            crossings = find_zero_crossings(block)
+            trace = crossings.event
+            self.number_of_zxings_per_cell[trace, (crossings.sample + stop_cells[trace]) % n] += 1
+
+            cells, weights, lengths = crossing_pair_windows(block, stop_cells, total_cells=n, crossings=crossings)
+        with stage("accumulate", nbytes=weights.nbytes):
+            complete = weights.sum(axis=2) >= 30
+            for i, weight_matrix in enumerate(self.weight_matrices):
+                weight_matrix.append(cells[i][complete[i]], weights[i][complete[i]])
+
+    def fill_block(self, data, stop_cells):
+        for calibrated, stop_cell in zip(data, stop_cells):
+            self.fill(calibrated, stop_cell)
+
+    def solve(self, trace=0):
+        """
+        least squares cell widths of trace, the diagnostics of the solver
+        are kept in solver_diagnostics[trace].
+        """
+        start = time.time()
+        csr = self.weight_matrices[trace].tocsr()
+        b = np.ones(csr.shape[0])*1000/30
 
+        if self.scale_columns:
+            column_norm = np.sqrt(np.asarray(csr.multiply(csr).sum(axis=0))).ravel()
+            column_scale = np.where(column_norm > 0, 1 / np.where(column_norm > 0, column_norm, 1), 1.)
+            csr = csr @ diags(column_scale)
+        else:
+            column_scale = np.ones(self.total_cells)
 
-def calc_qr_tc(event_generator, calib, pixel, gain, cell_width_guess):
-    f_calib = 30e6 # in Hz
-    unit_of_ti = 1e-9 # in seconds
-    nominal_period = 1 / (f_calib * unit_of_ti)
+        x0 = None
+        if self.cell_width_guess is not None:
+            # the guess is a cell_width_mean column, which is rolled by one cell wrt. the solution
+            guess = np.broadcast_to(self.cell_width_guess, (self.n_traces, self.total_cells))[trace]
+            guess = np.nan_to_num(np.asarray(guess, dtype=np.float64), nan=1.)
+            x0 = np.roll(guess, -1) / column_scale
 
-    cell_width = np.copy(cell_width_guess) 
-    T = cell_width.sum()
-    stop_cells = np.zeros(1024, dtype=int)
-    number_of_zxings_per_cell = np.zeros(1024, dtype=int)
+        # lsqr calls the iteration limit iter_lim, lsmr maxiter
+        limit = {"lsqr": "iter_lim", "lsmr": "maxiter"}[self.solver]
+        result = SOLVERS[self.solver](
+            csr, b, atol=self.atol, btol=self.btol, x0=x0, **{limit: self.iter_lim})
+        cell_width = result[0] * column_scale
+
+        if self.solver == "lsqr":
+            istop, itn, r1norm, r2norm, anorm, acond, arnorm = result[1:8]
+            normr, normar, conda = r1norm, arnorm, acond
+        else:
+            istop, itn, normr, normar, norma, conda = result[1:7]
+        self.solver_diagnostics[trace] = {
+            "solver": self.solver,
+            "scale_columns": self.scale_columns,
+            "warm_start": x0 is not None,
+            "rows": csr.shape[0],
+            "nonzero": csr.nnz,
+            "istop": int(istop),
+            "iterations": int(itn),
+            "residual_norm": float(normr),
+            "normal_residual_norm": float(normar),
+            "condition_estimate": float(conda),
+            "seconds": time.time() - start,
+        }
+        return cell_width
+
+    def to_dataframe(self, trace=0):
+        with stage("solve"):
+            cell_width = self.solve(trace)
+
+        tc = pd.DataFrame({
+            "cell_width_mean": np.roll(cell_width, 1),
+            "cell_width_std": np.zeros(self.total_cells),  # np.full((len(cell_width), np.nan)
+            "number_of_crossings": self.number_of_zxings_per_cell[trace],
+            "stop_cell": self.stop_cells[trace],
+            })
+        return tc
+
+
+class OnlineQRTC(QRTC):
+    """
+    Same equations as QRTC, but instead of keeping every row, they are folded
+    into the normal equations A^T A x = A^T b (1024 x 1024 per trace),
+    whenever flush_rows rows are collected. So memory does not grow with the
+    number of events, and solve() gives the current cell widths at any time.
 
-    weight_matrix = []
-    for event_id, event in enumerate(tqdm(event_generator)):
-        event = calib(event)
+    The normal equations are solved directly, so there are no solver options,
+    cell_width_guess is accepted to be interchangeable with QRTC, but not needed.
+    """
+
+    def __init__(self, n_traces=1, total_cells=1024, cell_width_guess=None, flush_rows=2**15):
+        super().__init__(n_traces=n_traces, total_cells=total_cells, cell_width_guess=cell_width_guess)
+        self.flush_rows = flush_rows
+        self.normal_matrix = np.zeros((n_traces, total_cells, total_cells))
+        self.normal_vector = np.zeros((n_traces, total_cells))
+        self.b_norm_sq = np.zeros(n_traces)
+        self.n_rows = np.zeros(n_traces, dtype=np.int64)
+
+    def fill(self, calibrated, stop_cell):
+        super().fill(calibrated, stop_cell)
+        for trace, weight_matrix in enumerate(self.weight_matrices):
+            if weight_matrix.n_rows >= self.flush_rows:
+                self.fold(trace)
+
+    def fold(self, trace):
+        """ adds the collected rows of trace to its normal equations """
+        weight_matrix = self.weight_matrices[trace]
+        if not weight_matrix.n_rows:
+            return
+        with stage("fold"):
+            csr = weight_matrix.tocsr()
+            b_value = 1000/30
+            self.normal_matrix[trace] += (csr.T @ csr).toarray()
+            self.normal_vector[trace] += b_value * np.asarray(csr.sum(axis=0)).ravel()
+            self.b_norm_sq[trace] += weight_matrix.n_rows * b_value**2
+            self.n_rows[trace] += weight_matrix.n_rows
+            weight_matrix.clear()
+
+    def solve(self, trace=0):
+        start = time.time()
+        self.fold(trace)
+        ata = self.normal_matrix[trace]
+        atb = self.normal_vector[trace]
+        # lstsq, as cells without any crossing make A^T A singular
+        cell_width, _, rank, singular_values = np.linalg.lstsq(ata, atb, rcond=None)
+
+        residual_norm_sq = cell_width @ ata @ cell_width - 2 * cell_width @ atb + self.b_norm_sq[trace]
+        self.solver_diagnostics[trace] = {
+            "solver": "normal_equations",
+            "rows": int(self.n_rows[trace]),
+            "rank": int(rank),
+            "residual_norm": float(np.sqrt(max(residual_norm_sq, 0))),
+            # the singular values of A^T A are the squares of the ones of A
+            "condition_estimate": float(np.sqrt(singular_values[0] / singular_values[rank - 1])) if rank else np.inf,
+            "seconds": time.time() - start,
+        }
+        return cell_width
+
+
+def calc_qr_tc(event_generator, calib, pixel, gain, cell_width_guess, tc_class=QRTC, **solver_options):
+    """
+    returns the TC as DataFrame and the diagnostics of the solver.
+    tc_class is QRTC or OnlineQRTC, solver_options are passed on to it.
+    """
+    qr_tc = tc_class(cell_width_guess=cell_width_guess, **solver_options)
+
+    for event_id, event in enumerate(tqdm(profiling.iterate("read", event_generator))):
+        with stage("calibration", nbytes=profiling.nbytes(event)):
+            event = calib(event)
         calibrated = event.data[pixel][gain]
         stop_cell = event.header.stop_cells[pixel][gain]
-        stop_cells[stop_cell % 1024] += 1
-        zero_crossings = np.where(np.diff(np.signbit(calibrated)))[0]
-        number_of_zxings_per_cell[(zero_crossings+stop_cell)%1024] += 1
-
-        for zxing_type in [zero_crossings[0::2], zero_crossings[1::2]]:
-            for start, end in zip(zxing_type[:-1], zxing_type[1:]):
-
-                N = end - start + 1
-                weights = np.zeros(1024)
-                weights[(stop_cell + start + np.arange(N))%1024] = 1.
-                weights[(stop_cell + start)%1024] = 1 - weight_on_edge(calibrated, start)
-                weights[(stop_cell + end)%1024] = weight_on_edge(calibrated, end)
-                if weights.sum() < 30:
-                    continue
-                weight_matrix.append(weights[:])        
-
-    csr = csr_matrix(weight_matrix)
-    cell_width = lsqr(csr, np.ones(csr.shape[0])*1000/30)[0]
-
-    tc = pd.DataFrame({
-        "cell_width_mean": np.roll(cell_width, 1),
-        "cell_width_std": np.zeros(1024),  # np.full((len(cell_width), np.nan)
-        "number_of_crossings": number_of_zxings_per_cell,
-        "stop_cell": stop_cells,
-        })
-    return tc
+        qr_tc.fill(calibrated, stop_cell)
+
+    tc = qr_tc.to_dataframe()
+    return tc, qr_tc.solver_diagnostics[0]
+
+
+def calc_qr_tc_all(event_generator, calib, cell_width_guess, pixels=None, gains=None, tc_class=QRTC, **solver_options):
+    """
+    the QR TC of all pixels and gains (or the given ones) as one DataFrame,
+    and the diagnostics of the solver for every trace.
+    cell_width_guess is None, one row for all traces, or a function like in calc_global_tc_all.
+    """
+    def make_tc(traces):
+        guess = cell_width_guess(traces) if callable(cell_width_guess) else cell_width_guess
+        return tc_class(n_traces=len(traces), cell_width_guess=guess, **solver_options)
+
+    traces, qr_tc = fill_all_traces(event_generator, calib, make_tc, pixels, gains)
+
+    tc = tc_dataframe(traces, qr_tc)
+    diagnostics = [
+        dict(channel=pixel, gain=gain, **solver_diagnostics)
+        for (pixel, gain), solver_diagnostics in zip(traces, qr_tc.solver_diagnostics)
+    ]
+    return tc, diagnostics
+
 
 if __name__ == "__main__":
     args = docopt(__doc__)
+    if args["--profile"]:
+        profiling.enable(args["--profile"])
     args["--max_iterations"] = int(args["--max_iterations"])
-    pixel = int(args["--pixel"])
-    gain = args["--gain"]
-    assert gain in ["high", "low"]
+    all_traces = "all" in (args["--pixel"], args["--gain"])
+    pixel = None if args["--pixel"] == "all" else int(args["--pixel"])
+    gain = None if args["--gain"] == "all" else args["--gain"]
+    assert gain in ["high", "low", None]
     
     if not args["--fake"]:
-        event_generator = dr.EventGenerator(
+        event_generator = open_event_source(
             args["-i"], 
             max_events=args["--max_iterations"],
         )
@@ -107,18 +336,47 @@ if __name__ == "__main__":
         calib = lambda x: x
 
     if not args["--local_tc"]:
-        cell_width_guess = np.ones(1024)
+        cell_width_guess = None
+    elif all_traces:
+        cell_width_guess = partial(read_cell_widths, args["--local_tc"])
     else:
-        cell_width_guess = pd.read_csv(args["--local_tc"])["cell_width_mean"].values
+        cell_width_guess = read_tc(args["--local_tc"], pixel, gain)["cell_width_mean"].values
 
-    tc = calc_qr_tc(
-        event_generator, 
-        calib, 
-        pixel, 
-        gain, 
-        cell_width_guess)
+    if args["--online"]:
+        solver_options = dict(
+            tc_class=OnlineQRTC,
+            flush_rows=int(args["--flush_rows"]),
+        )
+    else:
+        solver_options = dict(
+            solver=args["--solver"],
+            atol=float(args["--atol"]),
+            btol=float(args["--btol"]),
+            iter_lim=None if args["--iter_lim"] == "auto" else int(args["--iter_lim"]),
+            scale_columns=args["--scale_columns"],
+        )
+    if all_traces:
+        tc, diagnostics = calc_qr_tc_all(
+            event_generator,
+            calib,
+            cell_width_guess,
+            pixels=None if pixel is None else [pixel],
+            gains=None if gain is None else [gain],
+            **solver_options)
+    else:
+        tc, diagnostics = calc_qr_tc(
+            event_generator, 
+            calib, 
+            pixel, 
+            gain, 
+            cell_width_guess,
+            **solver_options)
+        print("{solver}: {rows} rows, residual norm {residual_norm:.4g}, condition {condition_estimate:.4g}".format(**diagnostics))
 
     if args["--fake"]:
-        tc["cell_width_truth"] = event_generator.cell_widths / event_generator.cell_widths.mean()
+        cell_width_truth = event_generator.cell_widths / event_generator.cell_widths.mean()
+        tc["cell_width_truth"] = np.resize(cell_width_truth, len(tc))
      
-    tc.to_csv(args["-o"], index=False)
\ No newline at end of file
+    with stage("write"):
+        tc.to_csv(args["-o"], index=False)
+        write_diagnostics(args["-o"], diagnostics)
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""
+Helpers to look at one event as a 2D block of traces, one row per
+(channel, gain) combination, so the TC methods can update all channels
+at the same time, instead of reading the file once per channel and gain.
+"""
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import profiling
+from profiling import stage
+
+
+def select_traces(event, pixels=None, gains=None):
+    """
+    list of (pixel, gain) tuples found in event.
+    pixels and gains restrict the selection, None means all of them.
+    """
+    if pixels is None:
+        try:
+            pixels = list(event.data.keys())
+        except AttributeError:
+            pixels = list(range(len(event.data)))
+
+    traces = []
+    for pixel in pixels:
+        pixel_data = event.data[pixel]
+        if hasattr(pixel_data, "dtype"):
+            available_gains = list(pixel_data.dtype.names)
+        else:
+            available_gains = list(pixel_data.keys())
+
+        for gain in (available_gains if gains is None else gains):
+            traces.append((pixel, gain))
+    return traces
+
+
+def read_traces(event, traces):
+    """
+    returns data of shape (len(traces), roi) and stop_cells of shape (len(traces),)
+    """
+    data = np.array([event.data[pixel][gain] for pixel, gain in traces])
+    stop_cells = np.array([event.header.stop_cells[pixel][gain] for pixel, gain in traces])
+    return data, stop_cells
+
+
+def combine_traces(traces, tcs):
+    """
+    Concatenates one TC DataFrame per trace into a single DataFrame,
+    with additional columns "channel", "gain" and "cell" in front.
+    """
+    frames = []
+    for (pixel, gain), tc in zip(traces, tcs):
+        index = pd.DataFrame({
+            "channel": pixel,
+            "gain": gain,
+            "cell": np.arange(len(tc)),
+        })
+        frames.append(pd.concat([index, tc.reset_index(drop=True)], axis=1))
+    return pd.concat(frames, ignore_index=True)
+
+
+def tc_dataframe(traces, tc):
+    """ combine_traces of the to_dataframe(trace) of a TC with one row per trace """
+    return combine_traces(traces, [tc.to_dataframe(i) for i in range(len(traces))])
+
+
+def fill_all_traces(event_generator, calib, make_tc, pixels=None, gains=None):
+    """
+    Reads and calibrates every event once and fills all its traces, all pixels
+    and gains (or the given ones), into one TC, which make_tc(traces) creates,
+    as soon as the traces of the first event are known.
+    Stops early, when the TC has converged, like GlobalTC with a tolerance.
+
+    returns the traces and the TC.
+    """
+    traces = None
+    for event in tqdm(profiling.iterate("read", event_generator)):
+        with stage("calibration", nbytes=profiling.nbytes(event)):
+            event = calib(event)
+        if traces is None:
+            traces = select_traces(event, pixels, gains)
+            tc = make_tc(traces)
+        tc.fill(*read_traces(event, traces))
+        if getattr(tc, "converged", False):
+            break
+    return traces, tc
+
+
+def iter_event_blocks(events, traces, block_size=1000, calib=None):
+    """
+    Yields blocks of up to block_size events as
+    data of shape (n_events, len(traces), roi) and stop_cells of shape (n_events, len(traces)).
+
+    Event sources, which can produce blocks themselves, like the
+    event_cache.CachedEventGenerator, are sliced directly, if there is no calib.
+    """
+    if calib is None and hasattr(events, "iter_blocks"):
+        yield from profiling.iterate("read", events.iter_blocks(traces, block_size))
+        return
+
+    block = []
+    for event in profiling.iterate("read", events):
+        if calib is not None:
+            with stage("calibration", nbytes=profiling.nbytes(event)):
+                event = calib(event)
+        block.append(read_traces(event, traces))
+        if len(block) == block_size:
+            yield _stack(block)
+            block = []
+    if block:
+        yield _stack(block)
+
+
+def _stack(block):
+    data, stop_cells = zip(*block)
+    return np.stack(data), np.stack(stop_cells)
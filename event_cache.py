@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Usage:
+  event_cache.py <input> [options]
+
+Converts a Dragon board .dat file once into a columnar, memory mapped cache,
+so later runs do not need to decode the file again.
+
+Options:
+  -o PATH        path of the cache directory [default: <input>.cache]
+  --maxevents N  number of events to be converted [default: all]
+"""
+import os
+import json
+import warnings
+from itertools import islice
+import dragonboard as dr
+import numpy as np
+from tqdm import tqdm
+from docopt import docopt
+from fake_event_gen import Event, EventHeader_v5_1_05
+from event_blocks import select_traces
+
+
+def cache_path_for(path):
+    return path + ".cache"
+
+
+def source_stat(path, max_events=None):
+    """ what a cache of the file at path has to agree with to be used instead of it """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "max_events": max_events}
+
+
+def cache_is_valid(path, cache_path, max_events=None):
+    """
+    True, if the cache at cache_path was made of the file at path as it is now,
+    and contains at least the requested events. A cache, which was converted
+    with max_events, can only serve up to as many events.
+    """
+    with open(os.path.join(cache_path, "meta.json")) as f:
+        meta = json.load(f)
+    source = meta.get("source")
+    if source is None or not os.path.isfile(path):
+        return False
+    stat = source_stat(path)
+    if source["size"] != stat["size"] or source["mtime"] != stat["mtime"]:
+        return False
+    if source["max_events"] is None:
+        return True
+    return max_events is not None and max_events <= meta["n_events"]
+
+
+def convert(path, cache_path=None, max_events=None):
+    """
+    Reads all events of the .dat file at path and writes them into cache_path:
+
+      samples.npy     (n_events, n_channels) with one (roi,) field per gain
+      stop_cells.npy  (n_events, n_channels) with one field per gain
+      event_counter.npy, trigger_counter.npy, timestamp.npy  (n_events, )
+      meta.json       channels, gains, roi and the size, mtime and max_events of the source
+    """
+    if cache_path is None:
+        cache_path = cache_path_for(path)
+    os.makedirs(cache_path, exist_ok=True)
+
+    run = dr.EventGenerator(path, max_events=max_events)
+    n_events = len(run)
+
+    header = None
+    for i, event in enumerate(tqdm(run, total=n_events)):
+        if i == 0:
+            traces = select_traces(event)
+            channels = sorted(set(pixel for pixel, gain in traces))
+            gains = [gain for pixel, gain in traces if pixel == channels[0]]
+            roi = event.roi
+            sample_dtype = np.asarray(event.data[channels[0]][gains[0]]).dtype
+            stop_cell_dtype = np.asarray(event.header.stop_cells[channels[0]][gains[0]]).dtype
+            samples = np.lib.format.open_memmap(
+                os.path.join(cache_path, "samples.npy"), mode="w+",
+                dtype=[(gain, sample_dtype, (roi, )) for gain in gains],
+                shape=(n_events, len(channels)),
+            )
+            stop_cells = np.lib.format.open_memmap(
+                os.path.join(cache_path, "stop_cells.npy"), mode="w+",
+                dtype=[(gain, stop_cell_dtype) for gain in gains],
+                shape=(n_events, len(channels)),
+            )
+            # every header field in its own dtype, 64 bit counters do not fit into a float64
+            header = {
+                name: np.zeros(n_events, dtype=np.asarray(getattr(event.header, name)).dtype)
+                for name in ["event_counter", "trigger_counter", "timestamp"]
+            }
+
+        for c, pixel in enumerate(channels):
+            for gain in gains:
+                samples[gain][i, c] = event.data[pixel][gain]
+                stop_cells[gain][i, c] = event.header.stop_cells[pixel][gain]
+        for name in header:
+            header[name][i] = getattr(event.header, name)
+
+    if header is None:
+        raise ValueError("{} contains no events, there is nothing to cache".format(path))
+
+    samples.flush()
+    stop_cells.flush()
+    for name, values in header.items():
+        np.save(os.path.join(cache_path, name + ".npy"), values)
+    with open(os.path.join(cache_path, "meta.json"), "w") as f:
+        json.dump({
+            "channels": channels,
+            "gains": gains,
+            "roi": roi,
+            "n_events": n_events,
+            "source": source_stat(path, max_events),
+        }, f)
+    return cache_path
+
+
+class CachedEventGenerator:
+    """
+    Event source with the same interface as dr.EventGenerator,
+    but reading from a cache written by convert().
+    The arrays are memory mapped, so slicing event ranges does not copy.
+    """
+
+    def __init__(self, cache_path, max_events=None, start=0):
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            meta = json.load(f)
+        self.channels = meta["channels"]
+        self.gains = meta["gains"]
+        self.roi = meta["roi"]
+
+        def load(name):
+            return np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="r")
+
+        stop = None if max_events is None else start + max_events
+        s = slice(start, stop)
+        self.samples = load("samples")[s]
+        self.stop_cells = load("stop_cells")[s]
+        self.header = {
+            name: load(name)[s]
+            for name in ["event_counter", "trigger_counter", "timestamp"]
+        }
+        self.max_events = len(self.samples)
+
+    def __len__(self):
+        return self.max_events
+
+    def __iter__(self):
+        for i in range(self.max_events):
+            yield self.event(i)
+
+    def event(self, i):
+        event_header = EventHeader_v5_1_05(
+            int(self.header["event_counter"][i]),
+            int(self.header["trigger_counter"][i]),
+            self.header["timestamp"][i],
+            self.stop_cells[i],
+            None,
+        )
+        return Event(event_header, self.roi, self.samples[i], None)
+
+    def iter_blocks(self, traces, block_size=1000):
+        """
+        Same as event_blocks.iter_event_blocks, but slicing the cache directly,
+        without building single events.
+        """
+        channel_ids = [self.channels.index(pixel) for pixel, gain in traces]
+        for start in range(0, self.max_events, block_size):
+            s = slice(start, start + block_size)
+            data = np.stack([
+                self.samples[gain][s, c]
+                for c, (pixel, gain) in zip(channel_ids, traces)
+            ], axis=1)
+            stop_cells = np.stack([
+                self.stop_cells[gain][s, c]
+                for c, (pixel, gain) in zip(channel_ids, traces)
+            ], axis=1)
+            yield data, stop_cells
+
+
+def valid_cache_path(path, max_events=None):
+    """
+    path itself, if it is a cache directory, or the valid cache of the file at path.
+    None, if there is none. A cache of an older version of the file,
+    or with too few events, is not used.
+    """
+    if os.path.isfile(os.path.join(path, "meta.json")):
+        return path
+
+    cache_path = cache_path_for(path)
+    if os.path.isfile(os.path.join(cache_path, "meta.json")):
+        if cache_is_valid(path, cache_path, max_events):
+            return cache_path
+        warnings.warn("{} is outdated or incomplete, reading {} instead".format(cache_path, path))
+    return None
+
+
+def open_event_source(path, max_events=None):
+    """
+    Opens path as CachedEventGenerator, if it is a cache directory or
+    a valid cache for it exists, otherwise falls back to dr.EventGenerator.
+    """
+    cache_path = valid_cache_path(path, max_events)
+    if cache_path is not None:
+        return CachedEventGenerator(cache_path, max_events=max_events)
+    return dr.EventGenerator(path, max_events=max_events)
+
+
+def open_event_range(path, start, stop):
+    """
+    The events start ... stop-1 of path. A cache is sliced directly,
+    the .dat file has to be decoded from its beginning.
+    """
+    cache_path = valid_cache_path(path, stop)
+    if cache_path is not None:
+        return CachedEventGenerator(cache_path, max_events=stop - start, start=start)
+    return islice(dr.EventGenerator(path, max_events=stop), start, None)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    try:
+        args["--maxevents"] = int(args["--maxevents"])
+    except ValueError:
+        args["--maxevents"] = None
+    if args["-o"] == "<input>.cache":
+        args["-o"] = cache_path_for(args["<input>"])
+
+    print(convert(args["<input>"], args["-o"], max_events=args["--maxevents"]))
@@ -1,6 +1,7 @@
 import numpy as np
 from collections import namedtuple
-import pandas as pd
+from tc_store import read_tc
+from time_axis import TimeAxis
 
 Event = namedtuple(
     'Event', ['header', 'roi', 'data', 'time_since_last_readout']
@@ -15,11 +16,17 @@ EventHeader_v5_1_05 = namedtuple('EventHeader_v5_1_05', [
 ])
 
 
+EventBlock = namedtuple(
+    'EventBlock', ['event_counter', 'trigger_times', 'stop_cells', 'sample_times', 'data']
+)
+
+
 class FakeEventGenerator:
 
-    def __init__(self, trigger_times, pixel=0, gain="high", roi=1024, random_phase=True, sine_frequency=30e6, electronics_noise=10, cell_width=None):
-        self.times = list(trigger_times)
+    def __init__(self, trigger_times, pixel=0, gain="high", roi=1024, random_phase=True, sine_frequency=30e6, electronics_noise=10, cell_width=None, block_size=1000, seed=0):
+        self.trigger_times = np.asarray(trigger_times, dtype=np.float64)
         self.max_events = len(trigger_times)
+        self.block_size = block_size
         self.roi = roi
         self.pixel = pixel
         self.gain = gain
@@ -27,12 +34,11 @@ class FakeEventGenerator:
         self.random_phase = random_phase
         self.sine_frequency = sine_frequency
         self.electronics_noise = electronics_noise
-
-        np.random.seed(0)
+        self.seed = seed
 
         if not cell_width is None:
             try:
-                tc = pd.read_csv(cell_width)
+                tc = read_tc(cell_width, pixel, gain)
                 cw = tc.cell_width_mean.values
                 cw = np.clip(cw, 0.2, 10)
                 cw /= (cw.mean() / 1e-9)
@@ -42,26 +48,86 @@ class FakeEventGenerator:
                 self.cell_widths = cell_width
 
         else:
-            self.cell_widths = np.ones(1024) * 1e-9 + np.random.uniform(-0.5e-9, 0.5e-9, 1024)
+            rng = np.random.default_rng(np.random.SeedSequence(seed))
+            self.cell_widths = np.ones(1024) * 1e-9 + rng.uniform(-0.5e-9, 0.5e-9, 1024)
         
         self.cell_widths /= (self.cell_widths.mean() / 1e-9)
         self.nominal_width = self.cell_widths.mean()
         self.period = self.cell_widths.sum()
 
+        # the sample times of an event with stop cell sc are the end times of
+        # the cells sc ... sc+roi-1 since the start of cell 0 (+ full periods).
+        self.time_axis = TimeAxis(self.cell_widths)
+        self.cell_edges = self.time_axis.cumulative[0, 1:]
+        self._block = None
+
     def __len__(self):
         return self.max_events
 
-    def sine_wave(self, times, amplitude=1500):
+    def event_rng(self, event_counter):
+        """
+        random stream of a single event, derived from seed and event_counter only,
+        so event i is the same, no matter which process or block generates it.
+        """
+        return np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=(int(event_counter), ))
+        )
+
+    def sine_wave(self, times, event_counter, amplitude=1500):
+        """
+        times is either (roi, ) for a single event or (n_events, roi) for a block,
+        with one event_counter per event.
+        """
         omega = self.sine_frequency
-        if self.random_phase:
-            phase = np.random.uniform()
-        else:
+        rngs = [self.event_rng(i) for i in np.atleast_1d(event_counter)]
+
+        # phase is drawn before the noise in any case, so the noise does not depend on random_phase
+        phase = np.array([rng.uniform() for rng in rngs])[:, np.newaxis]
+        if not self.random_phase:
             phase = 0
         
-        signal = amplitude * np.sin(2 * np.pi * (omega * times + phase))
+        signal = amplitude * np.sin(2 * np.pi * (omega * np.atleast_2d(times) + phase))
         if self.electronics_noise:
-            signal += np.random.normal(0, self.electronics_noise, len(signal))
-        return signal
+            signal += np.array([
+                rng.normal(0, self.electronics_noise, signal.shape[1])
+                for rng in rngs
+            ])
+        return signal.reshape(np.shape(times))
+
+    def generate_block(self, start, stop):
+        """ events start ... stop-1 as EventBlock of arrays """
+        trigger_times = self.trigger_times[start:stop]
+        full_periods, part_period = np.divmod(trigger_times, self.period)
+
+        stop_cells = np.searchsorted(self.cell_edges, part_period)
+        sample_ids = stop_cells[:, np.newaxis] + np.arange(self.roi)
+        sample_times = (full_periods * self.period)[:, np.newaxis] + self.time_axis.start_time(sample_ids + 1)
+
+        event_counter = np.arange(start, stop)
+        return EventBlock(
+            event_counter,
+            trigger_times,
+            stop_cells,
+            sample_times,
+            self.sine_wave(sample_times, event_counter),
+        )
+
+    def next_block(self, size=None):
+        """ the next up to `size` events as EventBlock, raises StopIteration when there are none left """
+        if self.event_counter >= self.max_events:
+            raise StopIteration
+        start = self.event_counter
+        stop = min(start + (size or self.block_size), self.max_events)
+        self.event_counter = stop
+        self._block = None
+        return self.generate_block(start, stop)
+
+    def iter_blocks(self, traces, block_size=None):
+        """ see event_blocks.iter_event_blocks """
+        assert list(traces) == [(self.pixel, self.gain)], "fake events only contain {}".format((self.pixel, self.gain))
+        while self.event_counter < self.max_events:
+            block = self.next_block(block_size)
+            yield block.data[:, np.newaxis], block.stop_cells[:, np.newaxis]
 
     def __iter__(self):
         return self
@@ -73,21 +139,20 @@ class FakeEventGenerator:
         if self.event_counter >= self.max_events:
             raise StopIteration
 
-        time = self.times.pop(0)
-        full_periods, part_period = divmod(time, self.period)
-
-        sc = np.searchsorted(self.cell_widths.cumsum(), part_period)
-        sc_time = self.cell_widths[:sc].sum()
-        times = sc_time + full_periods * self.period + np.roll(self.cell_widths, -sc).cumsum()[:self.roi]
+        if self._block is None or self.event_counter > self._block.event_counter[-1]:
+            stop = min(self.event_counter + self.block_size, self.max_events)
+            self._block = self.generate_block(self.event_counter, stop)
+        i = self.event_counter - self._block.event_counter[0]
+        sc = self._block.stop_cells[i]
 
         event_header = EventHeader_v5_1_05(
             self.event_counter, 
-            times, 
-            time, 
+            self._block.sample_times[i],
+            self._block.trigger_times[i],
             {self.pixel:{self.gain:sc}},
             None
         )
-        data = {self.pixel: {self.gain: self.sine_wave(times)}}
+        data = {self.pixel: {self.gain: self._block.data[i]}}
 
         time_since_last_readout = None
         self.event_counter += 1
@@ -5,12 +5,13 @@ Usage:
 Options:
   --input PATH    path to file containing test pulses [default: LnG40.dat]
   --offset PATH   path to textfile with offset ala Taka, to be subtracted [default: Ped300Hz.dat]
-  --tc PATH       path to csv containting cell_widths [default: local_tc.csv]
+  --tc PATH       path to csv containting cell_widths, or <store>/<method> [default: local_tc.csv]
   --channel N     channel number to be analyszed [default: 0]
   --gain NAME     name of gain_type to be analysed. high/low [default: high]
   --maxevents N   number of events to be used [default: all]
   --png_out PATH  path to png, which should be saved [default: pulse_template.png]  
   --csv_out PATH  path to csv, which should be saved [default: pulse_dataframe.csv]
+  --profile PATH  write wall time, calls and bytes per stage to PATH (.json or .csv)
 """
 import dragonboard as dr
 import matplotlib.pyplot as plt
@@ -22,15 +23,18 @@ from docopt import docopt
 from scipy.interpolate import interp1d
 from matplotlib.colors import LogNorm
 import hist2d
-
-def digital_leading_edge_discriminator(data, time, threshold=0, window_length=0):
-    z = np.where(np.diff(np.signbit(data-threshold)))[0][0]
-    s = slice(z-window_length, z+2+window_length)
-    m, b = np.polyfit(time[s], data[s], deg=1)
-    return (threshold-b)/m
+from event_cache import open_event_source
+from event_blocks import iter_event_blocks
+from histograms import UniformHistogram2d
+from block_calibration import BlockCalibration, read_offsets
+from tc_store import read_tc
+import profiling
+from profiling import stage
 
 args = docopt(__doc__)
 args["--channel"] = int(args["--channel"])
+if args["--profile"]:
+    profiling.enable(args["--profile"])
 
 
 assert args["--gain"] in ["high", "low"]
@@ -40,12 +44,9 @@ except ValueError:
     args["--maxevents"] = None
 print(args)
 
-cell_width = pd.read_csv(args["--tc"])["cell_width"].values
-run = dr.EventGenerator(args["--input"], max_events=args["--maxevents"])
-offset = np.genfromtxt(args["--offset"])[:,0]
-# trick to omit np.roll
-offset = np.concatenate((offset, offset))
-cell_width = np.concatenate([cell_width]*5)
+cell_width = read_tc(args["--tc"], args["--channel"], args["--gain"])["cell_width_mean"].values
+run = open_event_source(args["--input"], max_events=args["--maxevents"])
+offset = read_offsets(args["--offset"])
 cell_width = np.roll(cell_width, 1)
 
 
@@ -55,18 +56,17 @@ gain = args["--gain"]
 
 
 bins = [np.linspace(50, 80, 301), np.linspace(-500, 2500, 601)]
-histo, _, _ = np.histogram2d([],[], bins=bins)
-
-for event in progress_bar(run, leave=True):
-    raw_data = event.data[ch][gain]
-    stop_cell = event.header.stop_cells[ch][gain]
-    
-    calibrated = raw_data - offset[stop_cell:stop_cell+run.roi]
-    t = cell_width[stop_cell:stop_cell+run.roi].cumsum()
-    h, _, _ = np.histogram2d(t, calibrated, bins=bins)
-    histo += h
+histogram = UniformHistogram2d(*bins)
+calibration = BlockCalibration(offset, cell_width)
 
+blocks = iter_event_blocks(run, [(ch, gain)], block_size=1000)
+for raw_data, stop_cells in progress_bar(blocks, unit="block", leave=True):
+    with stage("calibration", nbytes=raw_data.nbytes):
+        calibrated, t, cells = calibration(raw_data, stop_cells)
+    with stage("histogram", nbytes=calibrated.nbytes):
+        histogram.fill(t, calibrated)
 
+histo = histogram.counts.astype(np.float64)
 
 
 # normalize histo along y
@@ -0,0 +1,50 @@
+"""
+Histograms for filling with many large blocks of values.
+"""
+import numpy as np
+
+
+def uniform_bin_index(values, edges):
+    """
+    Bin index of values for uniformly spaced edges, computed arithmetically
+    instead of by a bin search, with the same result as np.histogram2d:
+    bins are half open, except the last one, which includes the right edge.
+
+    returns the indices and a mask of the values inside the edges.
+    """
+    n_bins = len(edges) - 1
+    low, high = edges[0], edges[-1]
+    inside = (values >= low) & (values <= high)
+
+    with np.errstate(invalid="ignore"):
+        index = np.floor((values - low) * (n_bins / (high - low)))
+    index = np.clip(np.nan_to_num(index), 0, n_bins - 1).astype(np.intp)
+
+    # the arithmetic can be off by one close to an edge, compare with the edges themselves.
+    index -= values < edges[index]
+    index += (values >= edges[index + 1]) & (index != n_bins - 1)
+    return index, inside
+
+
+class UniformHistogram2d:
+    """
+    Integer 2D histogram with fixed uniform bins, filled block by block
+    with a single np.bincount, instead of one np.histogram2d call per event.
+    counts are the same as the sum of np.histogram2d over all fills.
+    """
+
+    def __init__(self, x_edges, y_edges):
+        self.x_edges = np.asarray(x_edges, dtype=np.float64)
+        self.y_edges = np.asarray(y_edges, dtype=np.float64)
+        self.counts = np.zeros((len(self.x_edges) - 1, len(self.y_edges) - 1), dtype=np.int64)
+
+    def fill(self, x, y):
+        x = np.ravel(x)
+        y = np.ravel(y)
+        x_index, x_inside = uniform_bin_index(x, self.x_edges)
+        y_index, y_inside = uniform_bin_index(y, self.y_edges)
+        inside = x_inside & y_inside
+
+        n_y = self.counts.shape[1]
+        flat_index = x_index[inside] * n_y + y_index[inside]
+        self.counts += np.bincount(flat_index, minlength=self.counts.size).reshape(self.counts.shape)
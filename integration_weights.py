@@ -0,0 +1,99 @@
+"""
+Integration weights of the charge estimators per start cell of the window.
+
+integral_weighted, trapz and simps only depend on the cell widths of the
+cells inside the integration window, so on the DRS4 cell the window starts in.
+For a TC they are tabulated once for all total_cells start cells,
+then every charge estimator of a whole block is a single einsum of the
+samples in the window with the rows of the table.
+
+The tables are cached next to the TC, together with the cell widths
+they were made of, so a changed TC is noticed.
+"""
+import os
+import numpy as np
+from tc_store import tc_name
+
+ESTIMATORS = ["integral", "integral_weighted", "trapz", "simps"]
+
+
+def integration_length(int_window):
+    """ number of samples of an integration window, centered around the maximum """
+    return 2 * ((int_window - 1) // 2) + 1
+
+
+def window_weights(cell_width, window_length):
+    """
+    weights of shape (len(ESTIMATORS), total_cells, window_length), so that
+    estimate = weights[e, start_cell] @ samples, for the window_length samples
+    starting in start_cell. window_length needs to be odd for simps.
+    """
+    assert window_length % 2 == 1, "simps needs an odd number of samples"
+    cell_width = np.asarray(cell_width, dtype=np.float64)
+    total_cells = len(cell_width)
+    cells = (np.arange(total_cells)[:, np.newaxis] + np.arange(window_length)) % total_cells
+    weights = np.zeros((len(ESTIMATORS), total_cells, window_length))
+
+    weights[0] = 1
+
+    # for midpoint_rule each sample v_i gets mutiplied with 1/2 * (d_{i-1} + d_i)
+    midpoint_width = 1/2 * (cell_width + np.roll(cell_width, -1))
+    weights[1] = midpoint_width[cells]
+
+    # the time from sample i to i+1 is the width of the cell of sample i+1
+    h = cell_width[cells[:, 1:]]
+    weights[2, :, :-1] += h / 2
+    weights[2, :, 1:] += h / 2
+
+    # Simpson's rule for irregularly spaced samples, same as scipy.integrate.simps
+    h0 = h[:, 0::2]
+    h1 = h[:, 1::2]
+    h_sum = h0 + h1
+    weights[3, :, 0:-2:2] += h_sum / 6 * (2 - h1 / h0)
+    weights[3, :, 1:-1:2] += h_sum / 6 * h_sum**2 / (h0 * h1)
+    weights[3, :, 2::2] += h_sum / 6 * (2 - h0 / h1)
+    return weights
+
+
+class IntegrationWeights:
+
+    def __init__(self, cell_width, window_length, weights=None):
+        self.cell_width = np.asarray(cell_width, dtype=np.float64)
+        self.window_length = window_length
+        if weights is None:
+            weights = window_weights(self.cell_width, window_length)
+        self.weights = weights
+
+    def __call__(self, samples, start_cells):
+        """
+        samples of shape (n_events, window_length), start_cells (n_events, )
+        returns a dict with one array of estimates per estimator.
+        """
+        estimates = np.einsum("nl,enl->en", samples, self.weights[:, start_cells])
+        return dict(zip(ESTIMATORS, estimates))
+
+    def save(self, path):
+        np.savez(path, cell_width=self.cell_width, weights=self.weights)
+
+
+def weights_path(tc_spec, window_length, channel=0, gain="high"):
+    """ cache file of the weights next to the csv file or inside the store of tc_spec """
+    directory = os.path.dirname(tc_spec.rstrip("/"))
+    name = "{}_weights_{}_{}_{}.npz".format(tc_name(tc_spec), channel, gain, window_length)
+    return os.path.join(directory, name)
+
+
+def cached_weights(tc_spec, cell_width, window_length, channel=0, gain="high"):
+    """
+    IntegrationWeights of cell_width, the TC read from tc_spec, loaded from
+    the cache, if it was made of the same cell widths, else calculated and cached.
+    """
+    path = weights_path(tc_spec, window_length, channel, gain)
+    if os.path.isfile(path):
+        with np.load(path) as f:
+            if np.array_equal(f["cell_width"], cell_width):
+                return IntegrationWeights(cell_width, window_length, weights=f["weights"])
+
+    weights = IntegrationWeights(cell_width, window_length)
+    weights.save(path)
+    return weights
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Usage:
+  pipeline.py [options]
+
+Runs all TC methods and the pulse extraction, like `make all` does,
+but reads every input file only once and hands each block of events
+to all the analyses, which need it.
+
+Options:
+  --sine PATH         path to file with sine wave [default: SinWithHighOffset2.dat]
+  --sine_offset PATH  path to textfile with offsets ala Taka for the sine file [default: Ped300Hz_forSine.dat]
+  --pulses PATH       path to file containing test pulses [default: LnG40.dat]
+  --offset PATH       path to textfile with offset ala Taka for the test pulses [default: Ped300Hz.dat]
+  --channel N         channel number to be analyszed [default: 0]
+  --gain NAME         name of gain_type to be analysed. high/low [default: high]
+  --block_size N      number of events read at once [default: 1000]
+  --no_fake           skip the TC methods on fake events
+  --tolerance X       stop the global TC, when the RMS change of the cell widths over 500 events is below X, 0: never [default: 0]
+  --profile PATH      write wall time, calls and bytes per stage to PATH (.json or .csv)
+"""
+import dragonboard as dr
+import numpy as np
+from tqdm import tqdm
+from docopt import docopt
+from calc_local_tc import LocalTCAccumulator
+from calc_global_tc import GlobalTC, write_diagnostics
+from calc_qr_tc import QRTC
+from event_blocks import iter_event_blocks
+from event_cache import open_event_source
+from fake_event_gen import FakeEventGenerator
+from pulse_extraction import PulseExtraction
+from block_calibration import read_offsets
+from integration_weights import cached_weights, integration_length
+from extract_pulses import plot_resolutions
+from plot_tc import plot_tcs
+from tc_store import read_tc, tc_name, read_csv_tcs, write_store
+import profiling
+from profiling import stage
+
+
+class FirstEvents:
+    """ passes only the first max_events events on to consumer """
+
+    def __init__(self, consumer, max_events):
+        self.consumer = consumer
+        self.remaining = max_events
+
+    def fill_block(self, data, stop_cells):
+        n = min(len(data), self.remaining)
+        if n > 0:
+            self.consumer.fill_block(data[:n], stop_cells[:n])
+            self.remaining -= n
+
+
+def run_pass(blocks, consumers, total=None):
+    """ hands every block of events to all consumers """
+    for data, stop_cells in tqdm(blocks, total=total, unit="block"):
+        for consumer in consumers:
+            consumer.fill_block(data, stop_cells)
+
+
+def n_blocks(n_events, block_size):
+    return -(-n_events // block_size)
+
+
+def with_truth(tc, event_generator):
+    cell_width_truth = event_generator.cell_widths / event_generator.cell_widths.mean()
+    tc["cell_width_truth"] = np.resize(cell_width_truth, len(tc))
+    return tc
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    if args["--profile"]:
+        profiling.enable(args["--profile"])
+    block_size = int(args["--block_size"])
+    traces = [(int(args["--channel"]), args["--gain"])]
+    assert args["--gain"] in ["high", "low"]
+    tolerance = float(args["--tolerance"])
+
+    # sine wave: local, global and QR TC in one pass
+    run = open_event_source(args["--sine"])
+    calib = dr.calibration.TakaOffsetCalibration(args["--sine_offset"])
+    local_tc = LocalTCAccumulator()
+    global_tc = GlobalTC(np.ones(1024), tolerance=tolerance)
+    qr_tc = QRTC()
+    run_pass(
+        iter_event_blocks(run, traces, block_size=block_size, calib=calib),
+        [local_tc, FirstEvents(global_tc, 10000), FirstEvents(qr_tc, 7000)],
+        total=n_blocks(len(run), block_size),
+    )
+    csv_files = ["local_tc.csv", "global_tc.csv", "qr_tc.csv"]
+    # the QR solver only runs now, so it can start from the local TC
+    qr_tc.cell_width_guess = local_tc.to_dataframe()["cell_width_mean"].values
+    for tc, path in zip([local_tc, global_tc, qr_tc], csv_files):
+        tc.to_dataframe().to_csv(path, index=False)
+    write_diagnostics("global_tc.csv", global_tc.diagnostics())
+    write_diagnostics("qr_tc.csv", qr_tc.solver_diagnostics[0])
+
+    if not args["--no_fake"]:
+        # the fake local and global TC use the very same fake events
+        event_generator = FakeEventGenerator(
+            trigger_times=np.arange(10000)* (1/300),
+            random_phase=False,
+            sine_frequency=30e6 * (1+1e-7),
+            cell_width="local_tc.csv",
+            block_size=block_size,
+        )
+        local_tc_fake = LocalTCAccumulator()
+        global_tc_fake = GlobalTC(np.ones(1024), tolerance=tolerance)
+        run_pass(
+            profiling.iterate("generate", event_generator.iter_blocks([(0, "high")])),
+            [local_tc_fake, global_tc_fake],
+            total=n_blocks(event_generator.max_events, block_size),
+        )
+        with_truth(local_tc_fake.to_dataframe(), event_generator).to_csv("local_tc_fake.csv", index=False)
+        with_truth(global_tc_fake.to_dataframe(), event_generator).to_csv("global_tc_fake.csv", index=False)
+        write_diagnostics("global_tc_fake.csv", global_tc_fake.diagnostics())
+
+        event_generator = FakeEventGenerator(
+            trigger_times=np.arange(7000)* (1/300),
+            random_phase=True,
+            sine_frequency=30e6,
+            cell_width="local_tc.csv",
+            electronics_noise=50,
+            block_size=block_size,
+        )
+        qr_tc_fake = QRTC(cell_width_guess=local_tc_fake.to_dataframe()["cell_width_mean"].values)
+        run_pass(
+            profiling.iterate("generate", event_generator.iter_blocks([(0, "high")])),
+            [qr_tc_fake],
+            total=n_blocks(event_generator.max_events, block_size),
+        )
+        with_truth(qr_tc_fake.to_dataframe(), event_generator).to_csv("qr_tc_fake.csv", index=False)
+        write_diagnostics("qr_tc_fake.csv", qr_tc_fake.solver_diagnostics[0])
+        csv_files += ["local_tc_fake.csv", "global_tc_fake.csv", "qr_tc_fake.csv"]
+
+    # all TCs in one binary file as well
+    tcs = {}
+    for path in csv_files:
+        tcs.update(read_csv_tcs(path, *traces[0]))
+    write_store("tc.store", tcs)
+
+    # test pulses: the charge and time resolution with every TC in one pass
+    offset = read_offsets(args["--offset"])
+    extractions = {}
+    for path in ["local_tc.csv", "global_tc.csv", "qr_tc.csv"]:
+        cell_width = read_tc(path)["cell_width_mean"].values
+        weights = cached_weights(path, cell_width, integration_length(7), *traces[0])
+        extractions[tc_name(path)] = PulseExtraction(offset, cell_width, weights=weights)
+    run = open_event_source(args["--pulses"], max_events=20000)
+    run_pass(
+        iter_event_blocks(run, traces, block_size=block_size),
+        extractions.values(),
+        total=n_blocks(len(run), block_size),
+    )
+    with stage("plot"):
+        for tc_base_name, extraction in extractions.items():
+            plot_resolutions(extraction.to_dataframe(), tc_base_name)
+
+        plot_tcs(csv_files)
@@ -0,0 +1,158 @@
+"""
+Opt-in wall time, call counts and bytes processed per named stage of an analysis.
+
+Switched on by the --profile PATH option of the scripts, or by setting the
+environment variable DRS4_PROFILE=PATH. The report is written to PATH at exit,
+as CSV if PATH ends with .csv, else as JSON.
+When it is off, stage() hands out one shared do-nothing context manager
+and iterate() returns the iterable itself, so there is nearly no overhead.
+
+    with stage("zero_crossings", nbytes=data.nbytes):
+        ...
+    for event in iterate("read", event_generator):
+        ...
+"""
+import os
+import time
+import json
+import atexit
+from contextlib import nullcontext
+import pandas as pd
+
+_NOTHING = nullcontext()
+
+
+def nbytes(item):
+    """
+    size of an event, a block of arrays or an array in bytes, 0 if unknown.
+    Of an event only the data counts, also when it is a dict {pixel: {gain: array}}
+    like in fake events, but not the header.
+    """
+    if hasattr(item, "nbytes"):
+        return item.nbytes
+    if hasattr(item, "data"):
+        return nbytes(item.data)
+    if isinstance(item, dict):
+        return sum(nbytes(i) for i in item.values())
+    if isinstance(item, tuple):
+        return sum(nbytes(i) for i in item)
+    return 0
+
+
+class Profiler:
+
+    def __init__(self):
+        self.path = None
+        self.seconds = {}
+        self.calls = {}
+        self.bytes = {}
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, path):
+        if not self.enabled:
+            atexit.register(self.write)
+        self.path = path
+
+    def add(self, name, seconds, nbytes=0, calls=1):
+        self.seconds[name] = self.seconds.get(name, 0.) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+        self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def start_worker(self, path):
+        """
+        records from scratch in a worker process, as forked workers inherit the
+        stages of their parent and run several tasks. Unlike enable(), nothing is
+        written at exit, the worker returns its totals() to the parent instead.
+        """
+        self.path = path
+        self.seconds = {}
+        self.calls = {}
+        self.bytes = {}
+
+    def totals(self):
+        """ {stage: (seconds, calls, bytes)}, which add_totals() adds to another profiler """
+        return {name: (self.seconds[name], self.calls[name], self.bytes[name]) for name in self.seconds}
+
+    def add_totals(self, totals):
+        for name, (seconds, calls, nbytes) in totals.items():
+            self.add(name, seconds, nbytes, calls)
+
+    def stage(self, name, nbytes=0):
+        if self.path is None:
+            return _NOTHING
+        return _Stage(self, name, nbytes)
+
+    def iterate(self, name, iterable):
+        """ times getting every single item of iterable, e.g. decoding events """
+        if self.path is None:
+            return iterable
+        return _TimedIterable(self, name, iterable)
+
+    def to_dataframe(self):
+        df = pd.DataFrame({
+            "stage": list(self.seconds),
+            "seconds": list(self.seconds.values()),
+            "calls": [self.calls[name] for name in self.seconds],
+            "bytes": [self.bytes[name] for name in self.seconds],
+        })
+        df["megabytes_per_second"] = df.bytes / df.seconds / 1e6
+        return df
+
+    def write(self):
+        if not self.enabled or not self.seconds:
+            return
+        df = self.to_dataframe()
+        if self.path.endswith(".csv"):
+            df.to_csv(self.path, index=False)
+        else:
+            with open(self.path, "w") as f:
+                json.dump(df.to_dict(orient="records"), f, indent=2)
+
+
+class _Stage:
+
+    def __init__(self, profiler, name, nbytes):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.start, self.nbytes)
+
+
+class _TimedIterable:
+
+    def __init__(self, profiler, name, iterable):
+        self.profiler = profiler
+        self.name = name
+        self.iterable = iterable
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.profiler.add(self.name, time.perf_counter() - start, nbytes(item))
+            yield item
+
+
+profiler = Profiler()
+stage = profiler.stage
+iterate = profiler.iterate
+enable = profiler.enable
+
+if os.environ.get("DRS4_PROFILE"):
+    enable(os.environ["DRS4_PROFILE"])
@@ -0,0 +1,107 @@
+"""
+Charge and arrival time extraction for whole blocks of events at once.
+
+All functions take 2D arrays of shape (n_events, roi) plus one stop cell
+per event and give the same numbers, extract_pulses.py used to calculate
+event by event.
+"""
+import numpy as np
+import pandas as pd
+from profiling import stage
+from block_calibration import BlockCalibration
+from arrival_times import leading_edge, constant_fraction
+from integration_weights import IntegrationWeights, integration_length
+
+
+def extract_block(raw_data, stop_cells, offset, cell_width, int_window=7, threshold=1000, window_length=0, cfd_fraction=0.5, calibration=None, weights=None):
+    """
+    Extracts charge and arrival time of the test pulses of a block of events.
+
+    raw_data: (n_events, roi) uncalibrated samples
+    stop_cells: (n_events, ) stop cell of each event
+    offset: (total_cells, ) offset ala Taka per cell, to be subtracted
+    cell_width: (total_cells, ) cell widths of the time calibration
+    window_length: number of samples on either side of the threshold crossing,
+        which are used for the straight line of the arrival time as well
+    cfd_fraction: fraction of the maximum for the constant fraction arrival time
+    calibration: BlockCalibration of offset and cell_width, to reuse its buffers
+    weights: IntegrationWeights of cell_width for the integration window, e.g. from the cache
+
+    The integration window of 2*((int_window-1)//2)+1 samples is centered
+    around the maximum sample. It is shifted to stay inside the ROI.
+
+    returns a dict of arrays with one entry per event.
+    """
+    n_events, roi = raw_data.shape
+    total_cells = len(cell_width)
+    rows = np.arange(n_events)[:, np.newaxis]
+
+    if calibration is None:
+        calibration = BlockCalibration(offset, cell_width, total_cells=total_cells)
+    calibrated, t, cells = calibration(raw_data[:, np.newaxis], np.asarray(stop_cells)[:, np.newaxis])
+    calibrated, t, cells = calibrated[:, 0], t[:, 0], cells[:, 0]
+
+    max_pos = np.argmax(calibrated, axis=1)
+    window = integration_length(int_window)
+    start = np.clip(max_pos - window // 2, 0, roi - window)
+    samples = start[:, np.newaxis] + np.arange(window)
+    y = calibrated[rows, samples]
+
+    if weights is None:
+        weights = IntegrationWeights(cell_width, window)
+    charges = weights(y, cells[rows[:, 0], start])
+
+    return {
+        "integral": charges["integral"],
+        "integral_weighted": charges["integral_weighted"],
+        "max_pos": max_pos,
+        "arrival_time": leading_edge(calibrated, t, threshold, window_length),
+        "arrival_time_no_calib": leading_edge(calibrated, np.arange(roi, dtype=np.float64), threshold, window_length),
+        "arrival_time_cfd": constant_fraction(calibrated, t, cfd_fraction, window_length),
+        "trapz": charges["trapz"],
+        "simps": charges["simps"],
+    }
+
+
+class PulseExtraction:
+    """
+    Collects the results of extract_block for consecutive blocks of events,
+    e.g. to extract the same events with several TCs in one pass over the file.
+    """
+
+    def __init__(self, offset, cell_width, int_window=7, threshold=1000, window_length=0, cfd_fraction=0.5, trace=0, weights=None):
+        self.offset = offset
+        self.cell_width = cell_width
+        self.int_window = int_window
+        self.threshold = threshold
+        self.window_length = window_length
+        self.cfd_fraction = cfd_fraction
+        self.trace = trace
+        self.calibration = BlockCalibration(offset, cell_width, total_cells=len(cell_width))
+        if weights is None:
+            weights = IntegrationWeights(cell_width, integration_length(int_window))
+        self.weights = weights
+        self.blocks = []
+
+    def fill_block(self, raw_data, stop_cells):
+        """ raw_data of shape (n_events, n_traces, roi), stop_cells of shape (n_events, n_traces) """
+        with stage("extraction", nbytes=raw_data.nbytes):
+            self.blocks.append(extract_block(
+                raw_data[:, self.trace],
+                stop_cells[:, self.trace],
+                self.offset,
+                self.cell_width,
+                int_window=self.int_window,
+                threshold=self.threshold,
+                window_length=self.window_length,
+                cfd_fraction=self.cfd_fraction,
+                calibration=self.calibration,
+                weights=self.weights,
+            ))
+
+    def to_dataframe(self):
+        dtypes = {"max_pos": "i4"}
+        return pd.DataFrame({
+            name: np.concatenate([block[name] for block in self.blocks]).astype(dtypes.get(name, "f4"))
+            for name in self.blocks[0]
+        })
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Usage:
+  tc_store.py import <store> <csv>... [options]
+  tc_store.py export <store> <method> <csv> [options]
+  tc_store.py list <store>
+
+Keeps the TCs of all methods, channels and gains in one memory mapped
+binary file, instead of one csv per method, channel and gain.
+The method is the name of the csv file without .csv, e.g. local_tc.
+csv files with channel and gain columns, like the ones of --pixel all,
+are imported with all their channels and gains.
+
+Options:
+  --channel N   channel of csv files without channel column [default: 0]
+  --gain NAME   gain of csv files without gain column [default: high]
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from docopt import docopt
+
+COLUMNS = ["cell_width_mean", "cell_width_std", "number_of_crossings", "stop_cell", "slope_mean", "cell_width_truth"]
+# only some methods have these, e.g. slope_mean only the local TC
+OPTIONAL_COLUMNS = ["slope_mean", "cell_width_truth"]
+
+
+def tc_dtype(total_cells=1024):
+    return np.dtype([
+        ("filled", np.bool_),
+        ("cell_width_mean", np.float64, (total_cells, )),
+        ("cell_width_std", np.float64, (total_cells, )),
+        ("number_of_crossings", np.int64, (total_cells, )),
+        ("stop_cell", np.int64, (total_cells, )),
+        ("slope_mean", np.float64, (total_cells, )),
+        ("cell_width_truth", np.float64, (total_cells, )),
+    ])
+
+
+def write_store(path, tcs, total_cells=1024):
+    """
+    Writes the TC DataFrames in tcs, a dict {(method, channel, gain): tc},
+    as a new store into directory path:
+
+      tc.npy     (n_methods, n_channels, n_gains) with one field per column
+      meta.json  methods, channels, gains, total_cells and the columns of every method
+
+    Columns a TC does not have, like cell_width_truth, are NaN.
+    """
+    methods = sorted(set(method for method, channel, gain in tcs))
+    channels = sorted(set(channel for method, channel, gain in tcs))
+    gains = sorted(set(gain for method, channel, gain in tcs))
+
+    os.makedirs(path, exist_ok=True)
+    store = np.lib.format.open_memmap(
+        os.path.join(path, "tc.npy"), mode="w+",
+        dtype=tc_dtype(total_cells),
+        shape=(len(methods), len(channels), len(gains)),
+    )
+    for name in ["cell_width_mean", "cell_width_std"] + OPTIONAL_COLUMNS:
+        store[name] = np.nan
+    # the columns in the order of the csv files, so they come back the same
+    columns = {}
+
+    for (method, channel, gain), tc in tcs.items():
+        entry = store[methods.index(method), channels.index(channel), gains.index(gain)]
+        entry["filled"] = True
+        columns.setdefault(method, [name for name in tc.columns if name in COLUMNS])
+        for name in COLUMNS:
+            if name in tc:
+                entry[name] = tc[name].values
+    store.flush()
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({
+            "methods": methods,
+            "channels": channels,
+            "gains": gains,
+            "total_cells": total_cells,
+            "columns": columns,
+        }, f)
+    return path
+
+
+class TCStore:
+    """
+    Read only view of a store written by write_store(). The file is memory mapped,
+    so opening it costs nothing and store[method, channel, gain] is a record
+    with one (total_cells, ) array per column, not a copy.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.path = path
+        self.methods = meta["methods"]
+        self.channels = meta["channels"]
+        self.gains = meta["gains"]
+        self.total_cells = meta["total_cells"]
+        self.columns = meta.get("columns", {})
+        self.tc = np.load(os.path.join(path, "tc.npy"), mmap_mode="r")
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        """ raises KeyError also for entries, which were never imported, they only hold NaN """
+        method, channel, gain = key
+        try:
+            index = self.methods.index(method), self.channels.index(channel), self.gains.index(gain)
+        except ValueError:
+            raise KeyError(key)
+        entry = self.tc[index]
+        if not entry["filled"]:
+            raise KeyError(key)
+        return entry
+
+    def keys(self):
+        return [
+            (method, channel, gain)
+            for method in self.methods
+            for channel in self.channels
+            for gain in self.gains
+            if (method, channel, gain) in self
+        ]
+
+    def to_dataframe(self, method, channel, gain):
+        """ the TC as DataFrame with the columns of the csv files """
+        entry = self[method, channel, gain]
+        tc = pd.DataFrame({name: np.array(entry[name]) for name in COLUMNS})
+        if method in self.columns:
+            return tc[self.columns[method]]
+        for name in OPTIONAL_COLUMNS:
+            if tc[name].isna().all():
+                del tc[name]
+        return tc
+
+    def to_csv(self, path, method, channel, gain):
+        self.to_dataframe(method, channel, gain).to_csv(path, index=False)
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, "meta.json")) and os.path.isfile(os.path.join(path, "tc.npy"))
+
+
+def tc_name(spec):
+    """ name of a TC, given as path to a csv file or as <store>/<method> """
+    name = os.path.basename(spec)
+    return name[:-4] if name.endswith(".csv") else name
+
+
+def read_tc(spec, channel=0, gain="high"):
+    """
+    Reads the TC of channel and gain as DataFrame, from either
+    a csv file or from a store, given as <store>/<method>.
+    csv files without channel and gain columns are returned as they are.
+    """
+    store_path, method = os.path.split(spec.rstrip("/"))
+    if not spec.endswith(".csv") and is_store(store_path):
+        return TCStore(store_path).to_dataframe(method, channel, gain)
+
+    tc = pd.read_csv(spec, float_precision="round_trip")
+    if "channel" in tc and "gain" in tc:
+        tc = tc[(tc.channel == channel) & (tc.gain == gain)].reset_index(drop=True)
+        if not len(tc):
+            raise KeyError((tc_name(spec), channel, gain))
+    return tc
+
+
+def read_cell_widths(spec, traces):
+    """ cell_width_mean of every (channel, gain) in traces from read_tc, shape (len(traces), total_cells) """
+    return np.array([read_tc(spec, channel, gain)["cell_width_mean"].values for channel, gain in traces])
+
+
+def read_csv_tcs(path, channel=0, gain="high"):
+    """ dict {(method, channel, gain): tc} of all TCs in the csv file at path """
+    method = tc_name(path)
+    tc = pd.read_csv(path, float_precision="round_trip")
+    if not ("channel" in tc and "gain" in tc):
+        return {(method, channel, gain): tc}
+    return {
+        (method, int(c), g): trace_tc.reset_index(drop=True)
+        for (c, g), trace_tc in tc.groupby(["channel", "gain"])
+    }
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    channel = int(args["--channel"])
+    gain = args["--gain"]
+
+    if args["import"]:
+        tcs = {}
+        if is_store(args["<store>"]):
+            store = TCStore(args["<store>"])
+            tcs = {key: store.to_dataframe(*key) for key in store.keys()}
+            del store
+        for path in args["<csv>"]:
+            tcs.update(read_csv_tcs(path, channel, gain))
+        write_store(args["<store>"], tcs)
+
+    elif args["export"]:
+        store = TCStore(args["<store>"])
+        store.to_csv(args["<csv>"][0], args["<method>"], channel, gain)
+
+    elif args["list"]:
+        store = TCStore(args["<store>"])
+        for key in store.keys():
+            print(*key)
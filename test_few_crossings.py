@@ -0,0 +1,50 @@
+"""
+Events with less than 3 zero crossings contain no pair of crossings,
+the TC methods have to skip them, like the loops over the pairs always did,
+and a trace without any pair must still give diagnostics, which can be written.
+"""
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("dragonboard")
+from calc_global_tc import GlobalTC, crossing_pair_windows, write_diagnostics
+from calc_qr_tc import QRTC, OnlineQRTC
+
+
+def trace_with_crossings(n_crossings, roi=300):
+    """ a trace, which changes its sign n_crossings times """
+    trace = np.full(roi, -100.)
+    for k in range(n_crossings):
+        trace[50 + 40 * k:] *= -1
+    return trace
+
+
+@pytest.mark.parametrize("n_crossings", [0, 1, 2])
+def test_crossing_pair_windows(n_crossings):
+    cells, weights, lengths = crossing_pair_windows(trace_with_crossings(n_crossings), 17)
+    assert len(cells) == len(weights) == len(lengths) == 0
+
+
+@pytest.mark.parametrize("tc_class", [GlobalTC, QRTC])
+@pytest.mark.parametrize("n_crossings", [0, 1, 2])
+def test_fill(tc_class, n_crossings):
+    tc = GlobalTC(np.ones(1024)) if tc_class is GlobalTC else QRTC()
+    tc.fill(trace_with_crossings(n_crossings), 17)
+    tc.fill_block(trace_with_crossings(n_crossings)[np.newaxis, np.newaxis], np.array([[17]]))
+    assert tc.stop_cells.sum() == 2
+
+
+@pytest.mark.parametrize("tc_class", [GlobalTC, QRTC, OnlineQRTC])
+@pytest.mark.parametrize("n_crossings", [0, 1, 2])
+def test_write_diagnostics(tc_class, n_crossings, tmp_path):
+    tc = GlobalTC(np.ones(1024)) if tc_class is GlobalTC else tc_class()
+    tc.fill(trace_with_crossings(n_crossings), 17)
+    tc.to_dataframe()
+    diagnostics = tc.diagnostics() if tc_class is GlobalTC else tc.solver_diagnostics
+
+    with open(write_diagnostics(str(tmp_path / "tc.csv"), diagnostics)) as f:
+        written = json.load(f)
+    if tc_class is OnlineQRTC:
+        assert written[0]["rank"] == 0
+        assert written[0]["condition_estimate"] is None
@@ -0,0 +1,53 @@
+"""
+A store holds every combination of the imported methods, channels and gains,
+the ones, which were never imported, must not be read as TCs full of NaN.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from tc_store import write_store, TCStore, read_tc, read_cell_widths
+
+
+def local_tc(value, total_cells=1024):
+    return pd.DataFrame({
+        "cell_width_mean": np.full(total_cells, value),
+        "cell_width_std": np.zeros(total_cells),
+        "number_of_crossings": np.ones(total_cells, dtype=int),
+        "stop_cell": np.ones(total_cells, dtype=int),
+    })
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    # channel 0 only has high gain, channel 1 only low gain
+    return write_store(str(tmp_path / "tc.store"), {
+        ("local_tc", 0, "high"): local_tc(1.),
+        ("local_tc", 1, "low"): local_tc(2.),
+    })
+
+
+def test_not_filled(store_path):
+    store = TCStore(store_path)
+    assert ("local_tc", 1, "low") in store
+    assert ("local_tc", 1, "high") not in store
+    assert store.keys() == [("local_tc", 0, "high"), ("local_tc", 1, "low")]
+    with pytest.raises(KeyError):
+        store["local_tc", 1, "high"]
+    with pytest.raises(KeyError):
+        read_tc(store_path + "/local_tc", 0, "low")
+
+
+def test_read_cell_widths(store_path, tmp_path):
+    traces = [(1, "low"), (0, "high")]
+    expected = [[2.] * 1024, [1.] * 1024]
+    np.testing.assert_array_equal(read_cell_widths(store_path + "/local_tc", traces), expected)
+
+    # the same from a csv file of --pixel all
+    path = str(tmp_path / "local_tc.csv")
+    pd.concat([
+        local_tc(1.).assign(channel=0, gain="high"),
+        local_tc(2.).assign(channel=1, gain="low"),
+    ]).to_csv(path, index=False)
+    np.testing.assert_array_equal(read_cell_widths(path, traces), expected)
+    with pytest.raises(KeyError):
+        read_tc(path, 1, "high")
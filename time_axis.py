@@ -0,0 +1,95 @@
+"""
+Sample times from cell widths, looked up in one cumulative table over the ring buffer.
+
+Instead of tiling the cell widths and summing them up again for every event,
+the sum of the cell widths from cell a to cell b is the difference of two
+entries of the cumulative table, plus whole periods of the ring when the
+samples wrap around. So any sample time costs two lookups, no matter where
+in the ROI the sample is, and all events of a block are looked up at once.
+
+Like cell_width[stop_cell:stop_cell+roi].cumsum(), sample k of an event
+gets the time from the start of its stop cell to the end of the cell of sample k.
+"""
+import numpy as np
+
+
+def reused_buffer(buffers, name, shape, dtype):
+    """
+    the array buffers[name] with the given shape, which is reallocated
+    only, when it is too small to hold a block of that shape.
+    """
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape[1:] != shape[1:] or len(buffer) < shape[0]:
+        buffer = np.empty(shape, dtype=dtype)
+        buffers[name] = buffer
+    return buffer[:shape[0]]
+
+
+class TimeAxis:
+    """
+    cell_widths is a table of shape (total_cells, ) or (n_traces, total_cells)
+    with one table per trace of a block, see block_calibration.BlockCalibration.
+    """
+
+    def __init__(self, cell_widths):
+        cell_widths = np.atleast_2d(np.asarray(cell_widths, dtype=np.float64))
+        self.n_tables, self.total_cells = cell_widths.shape
+        # cumulative[trace, c] is the time from the start of cell 0 to the start of cell c
+        self.cumulative = np.zeros((self.n_tables, self.total_cells + 1))
+        np.cumsum(cell_widths, axis=1, out=self.cumulative[:, 1:])
+        self.period = self.cumulative[:, -1]
+        self._buffers = {}
+
+    def _tables(self, stop_cells):
+        """ table index, that broadcasts with stop_cells of shape (n_events, ) or (n_events, n_traces) """
+        if self.n_tables == 1:
+            return 0
+        return np.arange(stop_cells.shape[-1])
+
+    def start_time(self, position, table=0):
+        """
+        time from the start of cell 0 to the start of the cell at position,
+        which counts on over several turns of the ring: position = turns * total_cells + cell
+        """
+        turns, cell = np.divmod(position, self.total_cells)
+        return self.cumulative[table, cell] + turns * self.period[table]
+
+    def times(self, stop_cells, samples, out=None):
+        """
+        times of the given samples, samples broadcasts with stop_cells[..., np.newaxis],
+        e.g. np.arange(roi) for the whole time axes, shape stop_cells.shape + (roi, ),
+        or (n_events, k) for k selected samples per event.
+
+        The result is written into out, if given. The intermediate arrays are
+        kept and reused for the next call with a block, which is not larger.
+        """
+        stop_cells = np.asarray(stop_cells)
+        table = self._tables(stop_cells)
+        shape = np.broadcast_shapes(stop_cells.shape + (1, ), np.shape(samples))
+        if out is None:
+            out = np.empty(shape)
+
+        # the cell after the sample, counted on over several turns of the ring
+        position = reused_buffer(self._buffers, "position", shape, np.intp)
+        turns = reused_buffer(self._buffers, "turns", shape, np.intp)
+        np.add(stop_cells[..., np.newaxis], samples, out=position)
+        position += 1
+        np.divmod(position, self.total_cells, out=(turns, position))
+
+        # position becomes the index into the flat cumulative tables
+        if np.ndim(table):
+            position += (table * (self.total_cells + 1))[:, np.newaxis]
+        np.take(self.cumulative.ravel(), position, out=out)
+
+        period = self.period[table]
+        if np.ndim(table):
+            period = period[:, np.newaxis]
+        turn_times = reused_buffer(self._buffers, "turn_times", shape, np.float64)
+        np.multiply(turns, period, out=turn_times)
+        out += turn_times
+        out -= self.cumulative[table, stop_cells][..., np.newaxis]
+        return out
+
+    def __call__(self, stop_cells, roi, out=None):
+        """ time axes of all events, shape stop_cells.shape + (roi, ) """
+        return self.times(stop_cells, np.arange(roi), out=out)
@@ -1,7 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 np.random.seed(0)  # toy mcs want to be repoducible
-from tqdm import tqdm
+from toy_mc import PulseMaxCounting, toy_cell_widths, accuracy_curve
 
 pulse_width = 4
 pulse_height = 1
@@ -11,50 +11,15 @@ N_cells = 30   # number of cells of toy drs chip (does not have to 1024 to work
 period = N_cells * nominal_cell_width
 N_trials = int(100000/3)
 
-def pulse(x, x0=0, sigma=1, A=1):
-    y = np.exp(-1/2*((x-x0)/sigma)**2)
-    return y
+cell_width = toy_cell_widths(N_cells, cell_width_variation, nominal_cell_width)
+toy = PulseMaxCounting(cell_width, pulse_width, pulse_height, nominal_cell_width)
 
-cell_width = np.ones(N_cells) + np.random.normal(0, cell_width_variation, size=N_cells)
-cell_width /= cell_width.mean() / nominal_cell_width  # make sure the average cell width == nominal_cell_width
+RR = accuracy_curve(toy, n_batches=100, batch_size=N_trials)
 
-cell_width_B = (cell_width + np.roll(cell_width, -1)) / 2
-
-dual_cell_width = np.concatenate((cell_width, cell_width))
-sample_times = dual_cell_width.cumsum() - dual_cell_width[0]  # from 0 to 2 x period
-
-
-max_cell = []
-results = []
-plt.ion()
 plt.figure()
-for j in range(100):
-    trigger_times = np.random.uniform(0, period, N_trials)
-    for trigger_time in tqdm(trigger_times):
-
-        stop_cell = np.searchsorted(sample_times, trigger_time)
-        event_sample_times = sample_times[stop_cell:stop_cell + N_cells]
-
-        pulse_time = trigger_time + period/2
-        p = pulse(event_sample_times, x0=pulse_time, sigma=pulse_width, A=pulse_height)
-        max_cell.append((p.argmax() + stop_cell) % N_cells)
-    
-
-    h, _ = np.histogram(np.array(max_cell), bins=np.arange(N_cells+1)-0.5)
-    h = h.astype('f8')
-    h /= h.mean() / nominal_cell_width
-
-    residuals = np.sqrt(((h - cell_width_B)**2).sum()) / nominal_cell_width
-    results.append((len(max_cell)/N_cells, residuals))
-
-    RR = np.array(results).T
-
-    plt.clf()
-    plt.plot(RR[0], RR[1], '.:' )
-    plt.grid()
-    plt.ylabel("SSE [nominal cell width]")
-    plt.xlabel("events per DRS4 cell")
-    plt.pause(0.01)
+plt.plot(RR[0], RR[1], '.:' )
+plt.grid()
+plt.ylabel("SSE [nominal cell width]")
+plt.xlabel("events per DRS4 cell")
 plt.ylim(0, 0.05)
-plt.ioff()
-plt.show()
\ No newline at end of file
+plt.show()
@@ -1,7 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 np.random.seed(0)  # toy mcs want to be repoducible
-from tqdm import tqdm
+from toy_mc import PulseMaxCounting, toy_cell_widths
 
 pulse_width = 4
 pulse_height = 1
@@ -11,37 +11,13 @@ N_cells = 30   # number of cells of toy drs chip (does not have to 1024 to work
 period = N_cells * nominal_cell_width
 N_trials = 100000
 
-def pulse(x, x0=0, sigma=1, A=1):
-    y = np.exp(-1/2*((x-x0)/sigma)**2)
-    return y
-
-cell_width = np.ones(N_cells) + np.random.normal(0, cell_width_variation, size=N_cells)
-cell_width /= cell_width.mean() / nominal_cell_width  # make sure the average cell width == nominal_cell_width
-
-dual_cell_width = np.concatenate((cell_width, cell_width))
-sample_times = dual_cell_width.cumsum() - dual_cell_width[0]  # from 0 to 2 x period
-
+cell_width = toy_cell_widths(N_cells, cell_width_variation, nominal_cell_width)
+toy = PulseMaxCounting(cell_width, pulse_width, pulse_height, nominal_cell_width)
 
 trigger_times = np.random.uniform(0, period, N_trials)
-max_cell = []
-stop_cells = []
-for trigger_time in tqdm(trigger_times):
-
-    stop_cell = np.searchsorted(sample_times, trigger_time)
-    event_sample_times = sample_times[stop_cell:stop_cell + N_cells]
-
-    pulse_time = trigger_time + period/2
-    p = pulse(event_sample_times, x0=pulse_time, sigma=pulse_width, A=pulse_height)
-    max_cell.append((p.argmax() + stop_cell) % N_cells)
-    stop_cells.append(stop_cell % N_cells)
-
-max_cell = np.array(max_cell)
-stop_cells = np.array(stop_cells)
-
+stop_cells, max_cell = toy.fill(trigger_times)
 
-h, _ = np.histogram(max_cell, bins=np.arange(N_cells+1)-0.5)
-h = h.astype('f8')
-h /= h.mean() / nominal_cell_width
+h = toy.cell_width_estimate()
 
 
 
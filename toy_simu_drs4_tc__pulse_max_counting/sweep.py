@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Usage:
+  sweep.py [options]
+
+Runs the toy MC for every combination of the comma separated parameter lists
+and writes one row per configuration and batch: the SSE of the TC against
+the events per DRS4 cell, e.g. to choose the event budget of a 1024 cell chip.
+
+Every configuration gets its own random stream, derived from --seed and the
+configuration itself, so adding values to a list does not change the points
+already there. Finished points are cached in --cache, an interrupted or
+extended sweep only runs the missing ones.
+
+Options:
+  --method LIST                calibration methods, see METHODS [default: pulse_max_counting]
+  --N_cells LIST               number of cells of the toy drs chip [default: 30,1024]
+  --pulse_width LIST           [default: 4]
+  --cell_width_variation LIST  [default: 0.23]
+  --max_events_per_cell N      events per cell at the end of a configuration [default: 10000]
+  --n_batches N                the SSE is measured after every batch [default: 50]
+  --repetitions N              independent toy chips per configuration [default: 1]
+  --seed N                     [default: 0]
+  --jobs N                     number of processes [default: 1]
+  --cache PATH                 directory of the finished points [default: sweep.cache]
+  -o PATH                      path of the results table [default: sweep.csv]
+  --png PATH                   plot SSE vs events per cell into PATH
+"""
+import os
+import json
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from docopt import docopt
+from tqdm import tqdm
+from toy_mc import PulseMaxCounting, toy_cell_widths, accuracy_curve
+
+METHODS = {
+    "pulse_max_counting": PulseMaxCounting,
+}
+
+
+def configurations(grid, repetitions=1):
+    """ one dict per combination of the values in grid, a dict of lists """
+    names = sorted(grid)
+    for values in itertools.product(*[grid[name] for name in names]):
+        for repetition in range(repetitions):
+            config = dict(zip(names, values))
+            config["repetition"] = repetition
+            yield config
+
+
+def config_key(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def run_config(config, seed=0):
+    """ the accuracy curve of one configuration, as table with one row per batch """
+    key = int(config_key(config)[:16], 16)
+    random = np.random.default_rng(np.random.SeedSequence([seed, key]))
+
+    nominal_cell_width = 1
+    N_cells = config["N_cells"]
+    cell_width = toy_cell_widths(N_cells, config["cell_width_variation"], nominal_cell_width, random=random)
+    toy = METHODS[config["method"]](cell_width, config["pulse_width"], 1, nominal_cell_width)
+
+    batch_size = config["max_events_per_cell"] * N_cells // config["n_batches"]
+    RR = accuracy_curve(toy, config["n_batches"], batch_size, random=random)
+
+    result = pd.DataFrame({"batch": np.arange(config["n_batches"]), "events_per_cell": RR[0], "sse": RR[1]})
+    for name, value in config.items():
+        result[name] = value
+    result["seed"] = seed
+    return result
+
+
+def cached_run_config(config, seed, cache):
+    """ run_config, but read from the cache directory, if it has been run before """
+    path = os.path.join(cache, "{}_{}.csv".format(config_key(config), seed))
+    if os.path.isfile(path):
+        return pd.read_csv(path, float_precision="round_trip")
+    result = run_config(config, seed)
+    # write under another name first, so an interrupted sweep leaves no half written points
+    result.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return result
+
+
+def sweep(configs, seed=0, cache="sweep.cache", jobs=1):
+    """ all configurations, jobs of them in parallel, as one tidy table """
+    os.makedirs(cache, exist_ok=True)
+    configs = list(configs)
+    if jobs == 1:
+        results = [cached_run_config(config, seed, cache) for config in tqdm(configs)]
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [pool.submit(cached_run_config, config, seed, cache) for config in configs]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+        results = [future.result() for future in futures]
+    return pd.concat(results, ignore_index=True)
+
+
+def plot_sweep(results, path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    parameters = ["method", "N_cells", "pulse_width", "cell_width_variation", "repetition"]
+    # only the parameters, which are swept, go into the labels
+    parameters = [name for name in parameters if results[name].nunique() > 1] or ["method"]
+    plt.figure()
+    for values, curve in results.groupby(parameters):
+        label = " ".join("{}={}".format(name, value) for name, value in zip(parameters, values))
+        plt.plot(curve.events_per_cell, curve.sse, '.:', label=label)
+    plt.grid()
+    plt.xscale("log")
+    plt.yscale("log")
+    plt.ylabel("SSE [nominal cell width]")
+    plt.xlabel("events per DRS4 cell")
+    plt.legend(loc="best", fontsize="small")
+    plt.savefig(path)
+    plt.close()
+
+
+def parse_list(text, dtype):
+    return [dtype(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    grid = {
+        "method": parse_list(args["--method"], str),
+        "N_cells": parse_list(args["--N_cells"], int),
+        "pulse_width": parse_list(args["--pulse_width"], float),
+        "cell_width_variation": parse_list(args["--cell_width_variation"], float),
+        "max_events_per_cell": [int(args["--max_events_per_cell"])],
+        "n_batches": [int(args["--n_batches"])],
+    }
+    for method in grid["method"]:
+        assert method in METHODS, "unknown method {}, choose from {}".format(method, list(METHODS))
+
+    results = sweep(
+        configurations(grid, int(args["--repetitions"])),
+        seed=int(args["--seed"]),
+        cache=args["--cache"],
+        jobs=int(args["--jobs"]),
+    )
+    results.to_csv(args["-o"], index=False)
+    if args["--png"]:
+        plot_sweep(results, args["--png"])
@@ -0,0 +1,97 @@
+"""
+Toy MC of the pulse max counting TC, for many events at once.
+
+A pulse arrives half a period after the trigger. The cell, in which its
+maximum is sampled, is counted. For uniformly distributed trigger times
+the counts per cell are proportional to (cellwidth_i + cellwidth_{i+1})/2.
+
+All trigger times of a batch are drawn at once, the stop cells found with
+one searchsorted, the pulses evaluated for all events in one array and the
+max cells counted with np.bincount, so the histogram can grow batch by batch.
+
+The pulse rises up to its maximum and falls afterwards, so the highest sample
+is one of the two samples around the pulse time. Only those are evaluated,
+which gives the same max cells as all samples of the event, also for 1024 cells.
+"""
+import numpy as np
+
+
+def pulse(x, x0=0, sigma=1, A=1):
+    y = np.exp(-1/2*((x-x0)/sigma)**2)
+    return y
+
+
+def toy_cell_widths(N_cells=30, cell_width_variation=0.23, nominal_cell_width=1, random=np.random):
+    """ random cell widths with mean nominal_cell_width, random is np.random or a Generator """
+    cell_width = np.ones(N_cells) + random.normal(0, cell_width_variation, size=N_cells)
+    cell_width /= cell_width.mean() / nominal_cell_width  # make sure the average cell width == nominal_cell_width
+    return cell_width
+
+
+class PulseMaxCounting:
+
+    def __init__(self, cell_width, pulse_width=4, pulse_height=1, nominal_cell_width=1, block_size=1000000):
+        self.cell_width = np.asarray(cell_width, dtype=np.float64)
+        self.N_cells = len(self.cell_width)
+        self.nominal_cell_width = nominal_cell_width
+        self.period = self.N_cells * nominal_cell_width
+        self.pulse_width = pulse_width
+        self.pulse_height = pulse_height
+        self.block_size = block_size
+
+        dual_cell_width = np.concatenate((self.cell_width, self.cell_width))
+        self.sample_times = dual_cell_width.cumsum() - dual_cell_width[0]  # from 0 to 2 x period
+        self.counts = np.zeros(self.N_cells, dtype=np.int64)
+
+    @property
+    def n_events(self):
+        return int(self.counts.sum())
+
+    def simulate(self, trigger_times):
+        """ stop cells and max cells of the events with the given trigger times """
+        trigger_times = np.asarray(trigger_times)
+        stop_cells = np.empty(len(trigger_times), dtype=np.intp)
+        max_cells = np.empty(len(trigger_times), dtype=np.intp)
+
+        for start in range(0, len(trigger_times), self.block_size):
+            s = slice(start, start + self.block_size)
+            stop_cell = np.searchsorted(self.sample_times, trigger_times[s])
+
+            # the samples just before and after the pulse time
+            pulse_time = trigger_times[s] + self.period/2
+            around = np.searchsorted(self.sample_times, pulse_time)[:, np.newaxis] + [-1, 0]
+            p = pulse(self.sample_times[around], x0=pulse_time[:, np.newaxis], sigma=self.pulse_width, A=self.pulse_height)
+            max_cells[s] = around[np.arange(len(around)), p.argmax(axis=1)] % self.N_cells
+            stop_cells[s] = stop_cell % self.N_cells
+        return stop_cells, max_cells
+
+    def fill(self, trigger_times):
+        """ adds the max cells of the events to the histogram, returns stop cells and max cells """
+        stop_cells, max_cells = self.simulate(trigger_times)
+        self.counts += np.bincount(max_cells, minlength=self.N_cells)
+        return stop_cells, max_cells
+
+    def cell_width_estimate(self):
+        """ the max cell histogram, normalized to the nominal cell width """
+        h = self.counts.astype('f8')
+        return h / (h.mean() / self.nominal_cell_width)
+
+    def expected(self):
+        """ what the normalized histogram converges to: (cellwidth_i + cellwidth_{i+1})/2 """
+        return (self.cell_width + np.roll(self.cell_width, -1)) / 2
+
+    def residuals(self):
+        """ distance of the histogram to expected() in units of the nominal cell width """
+        return np.sqrt(((self.cell_width_estimate() - self.expected())**2).sum()) / self.nominal_cell_width
+
+
+def accuracy_curve(toy, n_batches, batch_size, random=np.random):
+    """
+    fills toy with n_batches batches of batch_size uniform trigger times,
+    returns events per DRS4 cell and the residuals after every batch, shape (2, n_batches)
+    """
+    results = []
+    for j in range(n_batches):
+        toy.fill(random.uniform(0, toy.period, batch_size))
+        results.append((toy.n_events / toy.N_cells, toy.residuals()))
+    return np.array(results).T
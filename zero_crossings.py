@@ -0,0 +1,41 @@
+"""
+Zero crossings of whole blocks of traces in a single pass.
+
+All TC methods start from the zero crossings of the calibrated sine wave,
+find_zero_crossings() finds them for a block of any number of events
+and returns flat arrays, one entry per crossing.
+"""
+from collections import namedtuple
+import numpy as np
+
+ZeroCrossings = namedtuple("ZeroCrossings", ["event", "sample", "rising", "fraction", "slope"])
+ZeroCrossings.__doc__ = """
+event:    row of the block, for a 3D block (n_events, n_traces, n_samples)
+          this is event * n_traces + trace
+sample:   the crossing lies between sample and sample + 1
+rising:   True for rising, False for falling crossings
+fraction: where between sample and sample + 1 the straight line through both
+          crosses zero, 0 <= fraction <= 1. It is 1, when sample + 1 is exactly 0.
+          It is independent of the cell widths, so it needs no update,
+          when the estimation of the cell widths gets better.
+slope:    data[sample + 1] - data[sample], in the dtype of the data
+"""
+
+
+def find_zero_crossings(block):
+    """
+    All sign changes in a block of traces of shape (..., n_samples),
+    the crossings are sorted by event and sample.
+    """
+    block = np.asarray(block)
+    rows = block.reshape(-1, block.shape[-1])
+    event, sample = np.nonzero(np.diff(np.signbit(rows), axis=1))
+
+    # in the flattened block, sample z+1 of a trace still follows sample z.
+    flat = rows.ravel()
+    zxing = event * rows.shape[1] + sample
+    slope = flat[zxing + 1] - flat[zxing]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = - flat[zxing] / slope
+
+    return ZeroCrossings(event, sample, slope > 0, fraction, slope)